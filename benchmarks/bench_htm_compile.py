@@ -0,0 +1,61 @@
+"""Compares htm's tree-walking Fill with compiled templates.
+
+Templates are built programmatically, so that the size of the trees can be
+varied. Run with:
+
+    python benchmarks/bench_htm_compile.py
+"""
+
+from timeit import repeat
+
+from tagstr_site.htm import InterpolationConcrete, html
+from tagstr_site.tstring import Template
+
+
+def make_template(*parts: str | tuple[object]) -> Template:
+    """Strings are static, 1-tuples are interpolated values"""
+    args = []
+    for part in parts:
+        if isinstance(part, str):
+            if args and isinstance(args[-1], str):
+                args[-1] += part
+            else:
+                args.append(part)
+        else:
+            if not args or not isinstance(args[-1], str):
+                args.append('')
+            value, = part
+            args.append(InterpolationConcrete(lambda value=value: value, 'value'))
+    if not isinstance(args[-1], str):
+        args.append('')
+    return Template(tuple(args))
+
+
+def deep(depth: int) -> Template:
+    parts = []
+    for i in range(depth):
+        parts += ['<div class="level" data-i=', (i,), '>', f'level {i}']
+    parts += ['leaf']
+    parts += ['</div>'] * depth
+    return make_template(*parts)
+
+
+def wide(width: int) -> Template:
+    parts = ['<ul>']
+    for i in range(width):
+        parts += ['<li title=', (f'item {i}',), '>Item ', (i,), '</li>']
+    parts += ['</ul>']
+    return make_template(*parts)
+
+
+def main():
+    for name, template in [('deep (100)', deep(100)), ('wide (1000)', wide(1000))]:
+        for compiled in (False, True):
+            html(template, compiled=compiled)  # warm the parse and compile caches
+            best = min(repeat(lambda: html(template, compiled=compiled), number=20, repeat=5)) / 20
+            mode = 'compiled' if compiled else 'interpreted'
+            print(f'{name:<12} {mode:<12} {best * 1e3:8.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
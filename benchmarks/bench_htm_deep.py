@@ -0,0 +1,30 @@
+"""Fill and render time for increasingly deep htm trees.
+
+Both phases use explicit stacks, so the time per level should stay flat as
+the depth grows, well past the recursion limit. Run with:
+
+    python benchmarks/bench_htm_deep.py
+"""
+
+import sys
+from timeit import repeat
+
+from tagstr_site.htm import html
+
+from bench_htm_compile import deep
+
+
+def main():
+    print(f'recursion limit: {sys.getrecursionlimit()}')
+    for depth in (100, 1_000, 10_000, 50_000):
+        template = deep(depth)
+        html(template)  # warm the parse cache
+        fill = min(repeat(lambda: html(template), number=3, repeat=3)) / 3
+        node = html(template)
+        render = min(repeat(lambda: str(node), number=3, repeat=3)) / 3
+        print(f'depth {depth:>6}  fill {fill * 1e6 / depth:6.2f} us/level'
+              f'  render {render * 1e6 / depth:6.2f} us/level')
+
+
+if __name__ == '__main__':
+    main()
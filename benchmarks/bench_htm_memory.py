@@ -0,0 +1,71 @@
+"""Memory used by htm trees, measured with tracemalloc.
+
+Compares HtmlNode (slots, shared empty attrs/children) with the equivalent
+plain dataclass, which has a per-instance __dict__ and allocates an empty
+dict and list for every node. Both trees are copied from the same html()
+result, so that they share the same strings. Run with:
+
+    python benchmarks/bench_htm_memory.py
+"""
+
+import tracemalloc
+from dataclasses import dataclass, field
+
+from tagstr_site.htm import EMPTY_ATTRS, EMPTY_CHILDREN, HtmlNode, html
+
+from bench_htm_compile import make_template
+
+
+@dataclass
+class PlainNode:
+    tag: str
+    attrs: dict = field(default_factory=dict)
+    children: list = field(default_factory=list)
+
+
+def copy_as_html_node(node: HtmlNode) -> HtmlNode:
+    return HtmlNode(
+        node.tag,
+        dict(node.attrs) or EMPTY_ATTRS,
+        [copy_as_html_node(child) if isinstance(child, HtmlNode) else child for child in node.children]
+        or EMPTY_CHILDREN)
+
+
+def copy_as_plain_node(node: HtmlNode) -> PlainNode:
+    return PlainNode(
+        node.tag,
+        dict(node.attrs),
+        [copy_as_plain_node(child) if isinstance(child, HtmlNode) else child for child in node.children])
+
+
+def table(rows: int):
+    parts = ['<table>']
+    for i in range(rows):
+        parts += ['<tr class="row"><td>', (i,), '</td><td><img src="icon.png"/></td><td>', (f'name {i}',), '<br/></td></tr>']
+    parts += ['</table>']
+    return make_template(*parts)
+
+
+def measure(build):
+    tracemalloc.start()
+    try:
+        snapshot = tracemalloc.take_snapshot()
+        before, _ = tracemalloc.get_traced_memory()
+        result = build()
+        after, _ = tracemalloc.get_traced_memory()
+        allocations = sum(
+            stat.count_diff for stat in tracemalloc.take_snapshot().compare_to(snapshot, 'filename'))
+    finally:
+        tracemalloc.stop()
+    return result, after - before, allocations
+
+
+def main():
+    node = html(table(10_000))
+    for name, copy in [('HtmlNode', copy_as_html_node), ('PlainNode', copy_as_plain_node)]:
+        copied, size, allocations = measure(lambda: copy(node))
+        print(f'{name:<10} {size / 2**20:6.2f} MiB  {allocations:>7} blocks')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""Build and render time for increasingly deep htmldom documents.
+
+Whitespace is normalized once when parsing, and the tree is rendered into a
+single buffer, so the time per level should stay flat as the depth grows.
+Run with:
+
+    python benchmarks/bench_htmldom_deep.py
+"""
+
+from timeit import repeat
+
+from tagstr_site.htmldom import html
+
+from bench_htm_compile import make_template
+
+
+def indented(depth: int):
+    # Each level on its own, indented line, as written in a template
+    parts = ['\n']
+    for i in range(depth):
+        parts += ['    ' * (i + 1), '<div class="level" data-i=', (i,), '>\n']
+    parts += ['    ' * (depth + 1), 'leaf\n']
+    for i in reversed(range(depth)):
+        parts += ['    ' * (i + 1), '</div>\n']
+    return make_template(*parts)
+
+
+def main():
+    for depth in (10, 20, 50, 100, 200):
+        args = indented(depth).args
+        html(*args)  # warm the template cache
+        build = min(repeat(lambda: html(*args), number=20, repeat=5)) / 20
+        node = html(*args)
+        render = min(repeat(lambda: str(node), number=20, repeat=5)) / 20
+        print(f'depth {depth:>4}  build {build * 1e6 / depth:6.2f} us/level'
+              f'  render {render * 1e6 / depth:6.2f} us/level')
+
+
+if __name__ == '__main__':
+    main()
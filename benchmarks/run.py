@@ -0,0 +1,218 @@
+"""Compares the tag implementations on the same workloads.
+
+For each engine and workload, reports:
+
+* parse: time for just parsing the templates of the workload, uncached,
+  for engines that expose their parser
+* cold: time to build with the engine's template cache cleared before each
+  build, so including parsing templates (and compiling them, for engines
+  that generate code); only for engines with a cache_clear()
+* build: time for the tag function to turn templates into its result (a
+  tree, vdom or SQL object), with any caches warm
+* render: time to turn that result into a string, if the engine separates
+  the two
+* peak: peak memory traced while building and rendering once
+* blocks: memory blocks still allocated for the built result
+
+Workloads that an engine does not support are reported with the error. Run
+with:
+
+    python benchmarks/run.py [--json] [--engine htm] [--workload table]
+"""
+
+import argparse
+import json
+import tracemalloc
+from dataclasses import dataclass
+from timeit import Timer
+from typing import Any, Callable
+
+from tagstr_site import htm, htmlbuilder, htmldom, htmltag, sql
+from tagstr_site.tstring import Template
+
+from bench_htm_compile import deep, make_template
+
+
+@dataclass
+class Engine:
+    kind: str  # 'html' or 'sql'
+    build: Callable[[Template], Any]
+    render: Callable[[Any], str] | None = str
+    cache_clear: Callable[[], None] | None = None
+    # Parses a template without caching; used in place of build, so it is
+    # passed templates whose values are the results of parse
+    parse: Callable[[Template], Any] | None = None
+
+
+def vdom(tag: str, attrs: dict | None, children: list | None) -> dict:
+    return {'tagName': tag, 'attributes': attrs, 'children': children}
+
+
+_htmltag_html = htmltag.make_html_tag(vdom)
+
+ENGINES = {
+    'htm': Engine('html', htm.html, cache_clear=htm.cache_clear, parse=lambda template: htm.parse(template.args)),
+    'htm-compiled': Engine('html', lambda template: htm.html(template, compiled=True), cache_clear=htm.cache_clear),
+    'htmldom': Engine(
+        'html', lambda template: htmldom.html(*template.args), cache_clear=htmldom.cache_clear,
+        parse=lambda template: htmldom.parse(*template.args)),
+    'htmltag': Engine('html', lambda template: _htmltag_html(*template.args), None, htmltag.cache_clear),
+    'htmltag-str': Engine('html', lambda template: htmltag.html_str(*template.args), None, htmltag.cache_clear),
+    'htmlbuilder': Engine('html', htmlbuilder.html),
+    'sql': Engine('sql', sql.sql, None, sql.cache_clear),
+}
+
+
+# Workloads take the tag function of an engine, and return a function that
+# builds the result. Templates are created as part of building, as they would
+# be for t-strings, so that components see their own values.
+
+def greeting(tag):
+    template = make_template('<div class="greeting">Hello ', ('World',), '!</div>')
+    return lambda: tag(template)
+
+
+def table(tag, rows=1_000):
+    def build():
+        trs = [
+            tag(make_template('<tr><td>', (i,), '</td><td>', (f'name {i}',), '</td><td>', (i * 1.5,), '</td></tr>'))
+            for i in range(rows)
+        ]
+        return tag(make_template('<table><tbody>', (trs,), '</tbody></table>'))
+    return build
+
+
+def nested(tag, depth=100):
+    template = deep(depth)
+    return lambda: tag(template)
+
+
+def attributes(tag, count=100):
+    parts = ['<form>']
+    for i in range(count):
+        parts += [
+            '<input type="text" name=', (f'field{i}',), ' value=', (f'value{i}',),
+            ' placeholder=', (f'enter{i}',), ' data-row=', (i,), ' data-col=', (i % 7,), ' />'
+        ]
+    parts += ['</form>']
+    template = make_template(*parts)
+    return lambda: tag(template)
+
+
+def components(tag, cards=50):
+    def card(title, body):
+        return tag(make_template('<div class="card"><h2>', (title,), '</h2><p>', (body,), '</p></div>'))
+
+    def card_list(items):
+        return tag(make_template('<section class="cards">', ([card(title, body) for title, body in items],), '</section>'))
+
+    def page(items):
+        return tag(make_template('<main><h1>Cards</h1>', (card_list(items),), '</main>'))
+
+    items = [(f'Card {i}', f'Body of card {i}') for i in range(cards)]
+    return lambda: page(items)
+
+
+def nested_sql(tag, depth=10):
+    def build():
+        query = tag(make_template('select id, age from users where age > ', (18,)))
+        for i in range(depth):
+            query = tag(make_template('select * from (', (query,), ') where age < ', (100 - i,), ' and id != ', (i,)))
+        # Statements are analyzed when executed
+        return tuple(query)
+    return build
+
+
+WORKLOADS = {
+    'greeting': ('html', greeting),
+    'table': ('html', table),
+    'deep': ('html', nested),
+    'attributes': ('html', attributes),
+    'components': ('html', components),
+    'nested-sql': ('sql', nested_sql),
+}
+
+
+def best_time(func: Callable[[], Any], repeat: int) -> float:
+    timer = Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def measure_memory(build: Callable[[], Any], render: Callable[[Any], str] | None) -> tuple[int, int]:
+    tracemalloc.start()
+    try:
+        snapshot = tracemalloc.take_snapshot()
+        result = build()
+        blocks = sum(
+            stat.count_diff for stat in tracemalloc.take_snapshot().compare_to(snapshot, 'filename'))
+        if render is not None:
+            render(result)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak, blocks
+
+
+def run(engine_name: str, workload_name: str, repeat: int) -> dict:
+    engine = ENGINES[engine_name]
+    _, make_workload = WORKLOADS[workload_name]
+    record = {'engine': engine_name, 'workload': workload_name}
+    build = make_workload(engine.build)
+    try:
+        # Warm any caches
+        result = build()
+        if engine.render is not None:
+            engine.render(result)
+    except Exception as e:
+        return record | {'error': f'{type(e).__name__}: {e}'}
+    if engine.parse is not None:
+        record['parse_us'] = best_time(make_workload(engine.parse), repeat) * 1e6
+    if engine.cache_clear is not None:
+        def cold_build():
+            engine.cache_clear()
+            return build()
+        record['cold_us'] = best_time(cold_build, repeat) * 1e6
+    record['build_us'] = best_time(build, repeat) * 1e6
+    if engine.render is not None:
+        record['render_us'] = best_time(lambda: engine.render(result), repeat) * 1e6
+    record['peak_kib'], record['blocks'] = measure_memory(build, engine.render)
+    record['peak_kib'] /= 1024
+    return record
+
+
+def format_record(record: dict) -> str:
+    name = f'{record["engine"]:<14} {record["workload"]:<12}'
+    if 'error' in record:
+        return f'{name} {record["error"][:60]}'
+    parse, cold, render = (
+        f'{record[key]:11.1f}' if key in record else f'{"-":>11}'
+        for key in ('parse_us', 'cold_us', 'render_us'))
+    return f'{name} {parse} {cold} {record["build_us"]:11.1f} {render} {record["peak_kib"]:9.1f} {record["blocks"]:8}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--engine', action='append', choices=ENGINES, help='Repeat to select several')
+    parser.add_argument('--workload', action='append', choices=WORKLOADS, help='Repeat to select several')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help='Write the results as JSON to stdout')
+    args = parser.parse_args()
+
+    records = []
+    if not args.json:
+        print(f'{"engine":<14} {"workload":<12} {"parse (us)":>11} {"cold (us)":>11} {"build (us)":>11} {"render (us)":>11} {"peak (KiB)":>9} {"blocks":>8}')
+    for engine_name in args.engine or ENGINES:
+        for workload_name in args.workload or WORKLOADS:
+            if WORKLOADS[workload_name][0] != ENGINES[engine_name].kind:
+                continue
+            record = run(engine_name, workload_name, args.repeat)
+            records.append(record)
+            if not args.json:
+                print(format_record(record))
+    if args.json:
+        print(json.dumps(records, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,21 @@
 from __future__ import annotations
 
-from collections.abc import Iterable
-from html import escape
-from html.parser import HTMLParser
+from collections.abc import AsyncIterable, AsyncIterator, Iterable, Mapping
 from dataclasses import dataclass, field
-from typing import Any, Callable, Generator, Literal, NamedTuple, Protocol, Sequence, runtime_checkable
+from enum import IntEnum, auto
+from functools import wraps
+from html import escape, unescape
+from itertools import chain
+from operator import itemgetter
+from types import MappingProxyType
+import asyncio
+import inspect
+from typing import Any, Callable, Generator, Iterator, Literal, NamedTuple, Protocol, Sequence, runtime_checkable
+from weakref import WeakSet
 import re
 
+from tagstr_site.lru import CacheInfo, LRUCache
+from tagstr_site.taglib import Markup, escape_html
 from tagstr_site.tstring import Template
 
 
@@ -40,105 +49,265 @@ class HTML(Protocol):
     children: Sequence[str | HTML]
 
 
-# Use as an AST for HTML, with placeholders
+# Nodes built from templates share these read-only sentinels for empty attrs
+# and children, instead of allocating an empty dict and list per node, so
+# mutating the empty attrs or children of such a node fails. Nodes
+# constructed directly get their own dict and list by default, and compare
+# equal to nodes with empty children however these are stored.
 
-@dataclass
+EMPTY_ATTRS = MappingProxyType({})
+EMPTY_CHILDREN = ()
+
+
+# Use as an AST for HTML, with interpolations recorded by their index in the
+# template args (see Parts below)
+
+@dataclass(slots=True)
 class AstNode:
-    tag: str = None
-    attrs: list[tuple[str, str | None]] = field(default_factory=list)
-    children: list[str | AstNode] = field(default_factory=list)
+    tag: Parts | None = None
+    attrs: list[tuple[Parts, Parts | None]] = field(default_factory=list)
+    children: list[str | int | AstNode] = field(default_factory=list)
 
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class HtmlNode:
     tag: str
-    attrs: dict = field(default_factory=dict)
-    children: list[str | HtmlNode] = field(default_factory=list)
+    attrs: Mapping[str, Any] = field(default_factory=dict)
+    children: Sequence[str | HtmlNode] = field(default_factory=list)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        # Empty children may be the shared EMPTY_CHILDREN tuple
+        return (
+            self.tag == other.tag
+            and self.attrs == other.attrs
+            and (self.children == other.children or tuple(self.children) == tuple(other.children))
+        )
 
     def __str__(self):
-        attrs = []
-        for k, v in self.attrs.items():
-            match k, v:
-                case str(), bool():
-                    attrs.append(k)
-                case str(), int():
-                    attrs.append(f'{k}="{v}"')
-                case str(), str():
-                    attrs.append(f'{k}="{escape(v, quote=True)}"')
-                case 'style', dict() as css:
-                    # TODO are there other examples of dict structures
-                    # beside the style attr? Could this occur in a
-                    # custom tag?
-                    decl = []
-                    for property, value in css.items():
-                        decl.append(f'{property}: {value}')
-                    attrs.append(f'{k}="{escape(('; ').join(decl))}"')
-
-        children = []
-        for child in self.children:
+        return ''.join(self.iter_render())
+
+    def iter_render(self) -> Iterator[str]:
+        """Yields the rendered HTML as fragments, in document order, so that
+        the full string never needs to be materialized"""
+        yield from iter_render(self)
+
+    def render_to(self, writer: SupportsWrite) -> None:
+        """Writes the rendered HTML to writer, such as a file or a buffer"""
+        write = writer.write
+        for fragment in iter_render(self):
+            write(fragment)
+
+
+class SupportsWrite(Protocol):
+    def write(self, s: str, /) -> Any:
+        ...
+
+
+def render_style(css: Mapping[str, Any]) -> str:
+    return '; '.join(f'{property}: {value}' for property, value in css.items())
+
+
+def render_class(names: Mapping[str, Any]) -> str:
+    # Like the classnames convention in JS: the names with a truthy value
+    return ' '.join(name for name, enabled in names.items() if enabled)
+
+
+def render_attrs(attrs: dict) -> str:
+    rendered = []
+    for k, v in attrs.items():
+        match k, v:
+            case str(), bool():
+                rendered.append(k)
+            case str(), int():
+                rendered.append(f'{k}="{v}"')
+            case str(), str():
+                rendered.append(f'{k}="{escape_html(v)}"')
+            case 'style', dict() as css:
+                # TODO are there other examples of dict structures
+                # beside the style attr? Could this occur in a
+                # custom tag?
+                rendered.append(f'{k}="{escape_html(render_style(css))}"')
+            case 'class', dict() as names:
+                rendered.append(f'{k}="{escape_html(render_class(names))}"')
+    return ' '.join(rendered)
+
+
+def iter_render(node: HTML) -> Iterator[str]:
+    return iter_render_children((node,))
+
+
+def iter_render_children(children: Iterable[str | HTML]) -> Iterator[str | Pending]:
+    # Uses an explicit stack of (children, end tag) instead of recursion, so
+    # arbitrarily deep trees can be rendered
+    stack: list[tuple[Iterator[str | HTML], str]] = [(iter(children), '')]
+    while stack:
+        children, end = stack[-1]
+        for child in children:
             match child:
                 case str():
-                    children.append(escape(child))
+                    yield escape_html(child)
+                case HtmlNode():
+                    attrs = render_attrs(child.attrs)
+                    start = f'<{child.tag} {attrs}' if attrs else f'<{child.tag}'
+                    grandchildren = child.children
+                    if grandchildren and type(grandchildren[0]) is LazyChildren:
+                        grandchildren = peek_lazy(grandchildren)
+                    if grandchildren:
+                        yield f'{start}>'
+                        stack.append((iter(grandchildren), f'</{child.tag}>'))
+                        break
+                    yield f'{start}/>'
                 case HTML():
-                    children.append(str(child))
+                    # Other implementations of the HTML protocol render themselves
+                    yield str(child)
+                case LazyChildren():
+                    stack.append((iter(child), ''))
+                    break
+                case Pending():
+                    # Only in trees built by aiter_render, which awaits these
+                    yield child
+        else:
+            stack.pop()
+            if end:
+                yield end
 
-        spaced = [f'<{self.tag}']
-        if attrs:
-            spaced.append(' ')
-            spaced.append(' '.join(attrs))
 
-        if children:
-            spaced.append('>')
-            spaced.append(''.join(children))
-            spaced.append(f'</{self.tag}>')
-        else:
-            spaced.append('/>')
+def peek_lazy(children: list) -> Iterator | tuple:
+    """Children, or () if the leading lazy children are all empty
 
-        return ''.join(spaced)
+    Lazy children are only consumed up to their first item, so that a tag
+    with no children renders as <tag/>, as it would without lazy=True.
+    """
+    remaining = iter(children)
+    for child in remaining:
+        if type(child) is not LazyChildren:
+            return chain((child,), remaining)
+        items = iter(child)
+        for first in items:
+            return chain((first,), items, remaining)
+    return ()
 
 
-placeholder_re = re.compile(r'(x\$\d+x)')
-placeholder_index_re = re.compile(r'x\$(?P<index>\d+)x')
 valid_attribute_name_re = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_\-\.]*$')
 valid_tagname_re = re.compile(r'^(?!.*--)(?!-?[0-9])[\w-]+(-[\w-]+|[a-zA-Z])?$')
 
 
-def escape_placeholder(string: str) -> str:
-    return string.replace('$', '$$')
+# Static text, tag names, and attribute names and values are all represented
+# as Parts: a plain str if static, otherwise a tuple of str and int parts,
+# where each int is the index of an interpolation in the template args. For
+# example, <h{level}> has the tag ('h', 1).
+
+Parts = str | tuple[str | int, ...]
+
+
+def make_parts(parts: Iterable[str | int]) -> Parts:
+    if type(parts) is list and len(parts) == 1 and type(parts[0]) is str:
+        return parts[0]
+    merged: list[str | int] = []
+    for part in parts:
+        if part == '':
+            continue
+        if isinstance(part, str) and merged and isinstance(merged[-1], str):
+            merged[-1] += part
+        else:
+            merged.append(part)
+    match merged:
+        case []:
+            return ''
+        case [str() as s]:
+            return s
+        case _:
+            return tuple(merged)
+
+
+class State(IntEnum):
+    DATA = auto()
+    RAWTEXT = auto()
+    TAG_OPEN = auto()
+    TAG_NAME = auto()
+    BEFORE_ATTR = auto()
+    ATTR_NAME = auto()
+    AFTER_ATTR_NAME = auto()
+    BEFORE_ATTR_VALUE = auto()
+    ATTR_VALUE = auto()
+    END_TAG_OPEN = auto()
+    END_TAG_NAME = auto()
+    COMMENT = auto()
+    BOGUS_COMMENT = auto()
+
 
+# Elements whose content is not parsed as HTML, and elements that never have
+# content, so they do not need to be closed
+RAWTEXT_ELEMENTS = frozenset({'script', 'style'})
+VOID_ELEMENTS = frozenset({
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'link', 'meta', 'param', 'source', 'track', 'wbr',
+})
 
-def unescape_placeholder(string: str) -> str:
-    return string.replace('$$', '$')
+whitespace_re = re.compile(r'\s*')
+tag_name_re = re.compile(r'[^\s/>]+')
+attr_name_re = re.compile(r'[^\s/>=]+')
+unquoted_attr_value_re = re.compile(r'[^\s>]+')
+
+# Fast paths for AstParser.parse_data, with the same syntax as when tokenized
+# by the states: a complete start tag; the start of a start tag, up to where
+# the states would be in BEFORE_ATTR, such as before an interpolation; and a
+# complete end tag. Attributes are then split with attr_re.
+attr_re = re.compile(r'''\s+([^\s/>=]++)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>"'][^\s>]*+)))?''')
+starttag_re = re.compile(
+    r'''<([a-zA-Z][^\s/>]*+)((?:\s+[^\s/>=]++(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s>"'][^\s>]*+))?)*)\s*(/?)>''')
+starttag_prefix_re = re.compile(
+    r'''<([a-zA-Z][^\s/>]*+)(?=[\s/>])'''
+    r'''((?:\s+[^\s/>=]++(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s>"'][^\s>]*+(?=[\s>]))|(?=\s*[^\s=])))*)''')
+endtag_re = re.compile(r'</([^/>][^>]*)>')
 
 
 # NOTE: doesn't validate the following:
 #
-# Well-formed HTML - tags are properly closed - use stack field for this
 # Valid HTML, such as li must be a child of ul or ol
 
-class AstParser(HTMLParser):
+class AstParser:
+    """Tokenizes the args of a template directly into an AstNode tree.
+
+    Because interpolations are fed separately from the static strings, the
+    parser always knows where an interpolation occurs - in text, in a tag name,
+    or in an attribute name or value - and records it as an int part, without
+    needing to encode it as a placeholder string that HTML parsing must then
+    preserve.
+    """
+
     def __init__(self):
-        super().__init__()
         self.root = AstNode()
         self.stack: list[AstNode] = [self.root]
         self.index = 0
         self.exprs: dict[int, str] = {}
+        self.state = State.DATA
+        self.rawtext_end: re.Pattern | None = None
+        self.name: list[str | int] = []
+        self.attrs: list[tuple[Parts, Parts | None]] = []
+        self.attr_name: list[str | int] = []
+        self.attr_value: list[str | int] = []
+        self.quote = ''
 
     @property
     def parent(self):
         return self.stack[-1]
 
     def feed(self, arg: str | Interpolation) -> None:
-        match arg:
-            case str() as s:
-                super().feed(escape_placeholder(s))
-            case Interpolation() as interpolation:
-                self.exprs[self.index] = interpolation.expr
-                super().feed(f'x${self.index}x')
+        # Checked with isinstance, as matching the Interpolation protocol is
+        # slow, and args alternate between str and Interpolation anyway
+        if isinstance(arg, str):
+            self.feed_str(arg)
+        else:
+            self.exprs[self.index] = arg.expr
+            self.feed_interpolation(self.index)
         self.index += 1
 
     def result(self) -> AstNode:
-        self.close()
+        if self.state not in (State.DATA, State.RAWTEXT, State.COMMENT, State.BOGUS_COMMENT):
+            raise RuntimeError('Unexpected end of template in a tag')
         match self.root.children:
             case []:
                 raise ValueError('Nothing to return')
@@ -147,166 +316,906 @@ class AstParser(HTMLParser):
             case _:
                 return self.root
 
-    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
-        this_node = AstNode(tag, attrs)
-        last_node = self.parent
-        last_node.children.append(this_node)
-        self.stack.append(this_node)
+    def feed_interpolation(self, i: int) -> None:
+        match self.state:
+            case State.DATA | State.RAWTEXT:
+                self.parent.children.append(i)
+            case State.TAG_OPEN:
+                self.name = [i]
+                self.state = State.TAG_NAME
+            case State.TAG_NAME | State.END_TAG_NAME:
+                self.name.append(i)
+            case State.BEFORE_ATTR:
+                self.attr_name = [i]
+                self.state = State.ATTR_NAME
+            case State.ATTR_NAME:
+                self.attr_name.append(i)
+            case State.AFTER_ATTR_NAME:
+                self.add_attr(None)
+                self.attr_name = [i]
+                self.state = State.ATTR_NAME
+            case State.BEFORE_ATTR_VALUE:
+                self.quote = ''
+                self.attr_value = [i]
+                self.state = State.ATTR_VALUE
+            case State.ATTR_VALUE:
+                self.attr_value.append(i)
+            case State.END_TAG_OPEN:
+                self.name = [i]
+                self.state = State.END_TAG_NAME
+            case State.COMMENT | State.BOGUS_COMMENT:
+                # Like any other content of a comment, dropped
+                pass
+
+    def feed_str(self, s: str) -> None:
+        # Each state is handled by a method, which consumes as much of s as
+        # it can, and returns the position to continue from
+        pos = 0
+        end = len(s)
+        handlers = self.handlers
+        while pos < end:
+            pos = handlers[self.state](self, s, pos)
+
+    def parse_data(self, s: str, pos: int) -> int:
+        while True:
+            i = s.find('<', pos)
+            if i == -1:
+                self.add_text(unescape(s[pos:]))
+                return len(s)
+            self.add_text(unescape(s[pos:i]))
+            # Fast paths for complete tags without interpolations; anything
+            # else goes through the states one step at a time
+            if m := starttag_re.match(s, i):
+                self.start_tag(m[1], m[2])
+                self.add_starttag(self_closing=bool(m[3]))
+            elif m := endtag_re.match(s, i):
+                self.add_endtag([m[1]])
+            elif m := starttag_prefix_re.match(s, i):
+                self.start_tag(m[1], m[2])
+                self.state = State.BEFORE_ATTR
+                return m.end()
+            else:
+                self.state = State.TAG_OPEN
+                return i + 1
+            pos = m.end()
+            if self.state is not State.DATA:
+                return pos
+
+    def start_tag(self, name: str, attrs: str) -> None:
+        self.name = [name.lower()]
+        self.attrs = []
+        for m in attr_re.finditer(attrs):
+            name, double, single, unquoted = m.groups()
+            value = double if double is not None else single if single is not None else unquoted
+            self.attrs.append((name.lower(), value if value is None else unescape(value)))
+
+    def parse_rawtext(self, s: str, pos: int) -> int:
+        m = self.rawtext_end.search(s, pos)
+        if m is None:
+            self.add_text(s[pos:])
+            return len(s)
+        self.add_text(s[pos:m.start()])
+        self.name = []
+        self.state = State.END_TAG_NAME
+        return m.start() + 2
+
+    def parse_tag_open(self, s: str, pos: int) -> int:
+        c = s[pos]
+        if c == '/':
+            self.state = State.END_TAG_OPEN
+            return pos + 1
+        elif s.startswith('!--', pos):
+            self.state = State.COMMENT
+            return pos + 3
+        elif c in '!?':
+            self.state = State.BOGUS_COMMENT
+            return pos + 1
+        elif c.isascii() and c.isalpha():
+            self.name = []
+            self.state = State.TAG_NAME
+        else:
+            # Not a tag, so this is just text
+            self.add_text('<')
+            self.state = State.DATA
+        return pos
+
+    def parse_tag_name(self, s: str, pos: int) -> int:
+        if m := tag_name_re.match(s, pos):
+            self.name.append(m.group().lower())
+            pos = m.end()
+        if pos < len(s):
+            self.attrs = []
+            self.state = State.BEFORE_ATTR
+        return pos
 
-    def handle_data(self, data: str) -> None:
-        children = self.parent.children
-        children.append(data)
+    def parse_before_attr(self, s: str, pos: int) -> int:
+        pos = whitespace_re.match(s, pos).end()
+        if pos == len(s):
+            return pos
+        if s[pos] == '>':
+            self.add_starttag()
+            return pos + 1
+        elif s.startswith('/>', pos):
+            self.add_starttag(self_closing=True)
+            return pos + 2
+        elif s[pos] == '/':
+            return pos + 1
+        self.attr_name = []
+        self.state = State.ATTR_NAME
+        return pos
 
-    def handle_endtag(self, tag: str) -> None:
-        recovered_tag = self.recover_interpolations(tag)
-        recovered_parent = self.recover_interpolations(self.parent.tag)
-        if  recovered_tag != recovered_parent:
-            raise RuntimeError(f"Unexpected </{recovered_tag}>")
+    def parse_attr_name(self, s: str, pos: int) -> int:
+        if m := attr_name_re.match(s, pos):
+            self.attr_name.append(m.group().lower())
+            pos = m.end()
+        if pos < len(s):
+            self.state = State.AFTER_ATTR_NAME
+        return pos
+
+    def parse_after_attr_name(self, s: str, pos: int) -> int:
+        pos = whitespace_re.match(s, pos).end()
+        if pos == len(s):
+            return pos
+        if s[pos] == '=':
+            self.state = State.BEFORE_ATTR_VALUE
+            return pos + 1
+        self.add_attr(None)
+        self.state = State.BEFORE_ATTR
+        return pos
+
+    def parse_before_attr_value(self, s: str, pos: int) -> int:
+        pos = whitespace_re.match(s, pos).end()
+        if pos == len(s):
+            return pos
+        if s[pos] in '"\'':
+            self.quote = s[pos]
+            pos += 1
+        else:
+            self.quote = ''
+        self.attr_value = []
+        self.state = State.ATTR_VALUE
+        return pos
+
+    def parse_attr_value(self, s: str, pos: int) -> int:
+        if self.quote:
+            i = s.find(self.quote, pos)
+            if i == -1:
+                self.attr_value.append(unescape(s[pos:]))
+                return len(s)
+            self.attr_value.append(unescape(s[pos:i]))
+            pos = i + 1
+        else:
+            if m := unquoted_attr_value_re.match(s, pos):
+                self.attr_value.append(unescape(m.group()))
+                pos = m.end()
+            if pos == len(s):
+                return pos
+        self.add_attr(make_parts(self.attr_value))
+        self.state = State.BEFORE_ATTR
+        return pos
+
+    def parse_end_tag_open(self, s: str, pos: int) -> int:
+        if s.startswith('/>', pos):
+            # <//> closes whatever tag is open
+            self.add_endtag(None)
+            return pos + 2
+        elif s[pos] == '>':
+            self.state = State.DATA
+            return pos + 1
+        self.name = []
+        self.state = State.END_TAG_NAME
+        return pos
+
+    def parse_end_tag_name(self, s: str, pos: int) -> int:
+        i = s.find('>', pos)
+        if i == -1:
+            self.name.append(s[pos:])
+            return len(s)
+        self.name.append(s[pos:i])
+        self.add_endtag(self.name)
+        return i + 1
+
+    def parse_comment(self, s: str, pos: int) -> int:
+        i = s.find('-->', pos)
+        if i == -1:
+            return len(s)
+        self.state = State.DATA
+        return i + 3
+
+    def parse_bogus_comment(self, s: str, pos: int) -> int:
+        i = s.find('>', pos)
+        if i == -1:
+            return len(s)
+        self.state = State.DATA
+        return i + 1
+
+    def add_text(self, text: str) -> None:
+        if text:
+            children = self.parent.children
+            if children and isinstance(children[-1], str):
+                children[-1] += text
+            else:
+                children.append(text)
+
+    def add_attr(self, value: Parts | None) -> None:
+        self.attrs.append((make_parts(self.attr_name), value))
+
+    def add_starttag(self, self_closing: bool = False) -> None:
+        tag = make_parts(self.name)
+        this_node = AstNode(tag, self.attrs)
+        self.parent.children.append(this_node)
+        self.state = State.DATA
+        if self_closing or tag in VOID_ELEMENTS:
+            return
+        self.stack.append(this_node)
+        if tag in RAWTEXT_ELEMENTS:
+            self.rawtext_end = re.compile(f'</{tag}', re.IGNORECASE)
+            self.state = State.RAWTEXT
+
+    def add_endtag(self, name: list[str | int] | None) -> None:
+        self.state = State.DATA
+        if name is not None:
+            if len(name) == 1 and isinstance(name[0], str):
+                tag = name[0].strip().lower()
+            else:
+                tag = make_parts(part.strip().lower() if isinstance(part, str) else part for part in name)
+            if tag in VOID_ELEMENTS and tag != self.parent.tag:
+                # Never opened, see add_starttag
+                return
+            recovered_tag = self.recover_interpolations(tag)
+            if len(self.stack) == 1:
+                raise RuntimeError(f"Unexpected </{recovered_tag}>")
+            recovered_parent = self.recover_interpolations(self.parent.tag)
+            if recovered_tag != recovered_parent:
+                raise RuntimeError(f"Unexpected </{recovered_tag}>")
+        elif len(self.stack) == 1:
+            raise RuntimeError("Unexpected <//>")
         self.stack.pop()
 
-    def recover_interpolations(self, tag: str) -> str:
+    def recover_interpolations(self, tag: Parts) -> str:
+        if isinstance(tag, str):
+            return tag
         recovered_tag = []
-        for arg in _split_by_placeholder(tag):
-            match arg:
+        for part in tag:
+            match part:
                 case str() as s:
                     recovered_tag.append(s)
                 case int() as i:
                     recovered_tag.append(f'{{{self.exprs[i]}}}')
         return ''.join(recovered_tag)
 
-def _split_by_placeholder(s: str) -> str | int :
-    for split in placeholder_re.split(s):
-        if split != '':
-            if m := placeholder_index_re.match(split):
-                yield int(m.group('index'))
-            else:
-                yield unescape_placeholder(split)
+
+AstParser.handlers = {
+    State.DATA: AstParser.parse_data,
+    State.RAWTEXT: AstParser.parse_rawtext,
+    State.TAG_OPEN: AstParser.parse_tag_open,
+    State.TAG_NAME: AstParser.parse_tag_name,
+    State.BEFORE_ATTR: AstParser.parse_before_attr,
+    State.ATTR_NAME: AstParser.parse_attr_name,
+    State.AFTER_ATTR_NAME: AstParser.parse_after_attr_name,
+    State.BEFORE_ATTR_VALUE: AstParser.parse_before_attr_value,
+    State.ATTR_VALUE: AstParser.parse_attr_value,
+    State.END_TAG_OPEN: AstParser.parse_end_tag_open,
+    State.END_TAG_NAME: AstParser.parse_end_tag_name,
+    State.COMMENT: AstParser.parse_comment,
+    State.BOGUS_COMMENT: AstParser.parse_bogus_comment,
+}
+
+
+def require_one_value(it: Iterable) -> Any:
+    values = list(it)
+    if len(values) > 1:
+        raise ValueError("Value must be single")
+    return values[0]
+
+
+def flag_attr(it: Iterable[dict | str]) -> dict:
+    # An attribute without a value: either a splatted dict of attributes, or
+    # a boolean attribute
+    k_only = require_one_value(it)
+    match k_only:
+        case dict():
+            return k_only
+        case str():
+            return {k_only: True}
+
+
+def make_tag(elems: Iterable[HTML | Callable | str], attrs: dict, children: Sequence) -> HTML:
+    elems = list(elems)
+    if any(not isinstance(elem, str) for elem in elems):
+        if len(elems) > 1:
+            raise ValueError(f'Can only have a standalone HTML component in name: {elems!r}')
+        match elems[0]:
+            case HTML() as node:
+                # FIXME this is probably not the right way to override things. Need
+                # to determine a better default policy - and make it configurable
+                # for any given node supporting the HTML protocol
+                return type(node)(node.tag, node.attrs | attrs, [*node.children, *children])
+            case component:
+                # Same calling convention as htmldom components
+                return component(*children, **attrs)
+    else:
+        tag = ''.join(elems)
+        if not valid_tagname_re.match(tag):
+            raise ValueError(f'Not a valid tag: {tag}')
+        return HtmlNode(tag, attrs, children)
+
+
+@dataclass(slots=True, eq=False)
+class LazyChildren:
+    """Children from an iterable that is only consumed when rendered.
+
+    Used by html(..., lazy=True), so that for example rows from a generator
+    are rendered one at a time, without building the full tree first. As
+    with any generator, such a tree can only be rendered once.
+    """
+    source: Iterable
+    convert: Callable[[Any], Iterable[HTML | str]]
+
+    def __iter__(self) -> Iterator[HTML | str]:
+        for value in self.source:
+            yield from self.convert(value)
 
 
 @dataclass
 class Fill:
     args: Sequence[str | Interpolation]
+    lazy: bool = False
 
-    def split_by_placeholder(self, s: str) -> Generator[str | Interpolation]:
-        for split in placeholder_re.split(s):
-            if split != '':
-                if m := placeholder_index_re.match(split):
-                    yield self.args[int(m.group('index'))]
-                else:
-                    yield unescape_placeholder(split)
-
-    def fill(self, s: str, convert) -> Generator[dict | str | HTML]:
-        for i, split in enumerate(self.split_by_placeholder(s)):
-            match split:
-                case Interpolation() as interpolation:
-                    yield from convert(interpolation.getvalue())
+    def fill(self, parts: Parts, convert) -> Generator[dict | str | HTML]:
+        if isinstance(parts, str):
+            yield parts
+            return
+        for part in parts:
+            match part:
+                case int() as i:
+                    yield from convert(self.args[i].getvalue())
                 case str() as s:
                     yield s
 
     def convert_child(self, value: Any) -> Generator[HTML | str]:
+        # Strings are kept as is, and only escaped when rendered, unless they
+        # are Markup
         match value:
+            case Markup() | Pending() | LazyChildren():
+                yield value
+            case str() if not hasattr(value, '__html__'):
+                yield value
+            case _ if hasattr(value, '__html__'):
+                yield Markup(value.__html__())
             case HTML():
                 yield value
-            case str() as s:
-                yield escape(s)
+            case Iterable() as it if self.lazy:
+                yield LazyChildren(it, self.convert_child)
             case Iterable() as it:
                 for child in it:
                     yield from self.convert_child(child)
             case _:
                 # NOTE we could apply the format_spec, conv here
                 # applies to non-iterable values like integers, etc
-                yield escape(str(value))
+                yield str(value)
 
-    def convert_attr_key(self, value: Any) -> str:
+    def convert_attr_key(self, value: Any) -> list[str]:
         match value:
             case str() as s:
                 k = escape(s, quote=True)
                 if not valid_attribute_name_re.match(k):
                     raise ValueError(f'Not a valid attribute name: {k!r}')
-                return k
+                return [k]
             case _:
                 raise TypeError(f'Expected str, got {value!r}')
 
-    def convert_attr_value(self, value: Any) -> dict | list[str]:
+    def convert_attr_value(self, value: Any) -> list[dict | str]:
         match value:
             case dict() as d:
-                return d
+                return [d]
             case str() as s:
-                return [escape(s, quote=True)]
+                return [s]
             case int() as n:
                 return [str(n)]
             case _:
                 raise TypeError(f'Expected dict, str, or int, got {value!r}')
 
-    def fill_attr(self, k: str, v: str | None) -> dict:
-        def require_one_value(it):
-            values = list(it)
-            if len(values) > 1:
-                raise ValueError("Value must be single")
-            return values[0]
-
+    def fill_attr(self, k: Parts, v: Parts | None) -> dict:
         match k, v:
-            case str(), None:
-                k_only = require_one_value(self.fill(k, self.convert_attr_value))
-                match k_only:
-                    case dict():
-                        return k_only
-                    case str():
-                        return {k_only: True}
-            case str(), str():
+            case _, None:
+                return flag_attr(self.fill(k, self.convert_attr_value))
+            case _:
                 return {
                     require_one_value(self.fill(k, self.convert_attr_key)):
                     require_one_value(self.fill(v, self.convert_attr_value))
                 }
 
-    def convert_name(self, value: Any) -> HTML | str:
+    def convert_name(self, value: Any) -> list[HTML | Callable | str]:
         match value:
-            case HTML() as node:
-                return node
             case str() as s:
-                return s
+                return [s]
             case int() as n:
-                return str(n)
+                return [str(n)]
+            case HTML() as node:
+                return [node]
+            case _ if callable(value):
+                return [value]
             case _:
-                raise TypeError(f'Expected HTML, str, or int, got {value!r}')
-
-    def fill_tag(self, tag: str, attrs, children) -> HTML:
-        elems = list(self.fill(tag, self.convert_name))
-        if any(isinstance(elem, HTML) for elem in elems):
-            if len(elems) > 1:
-                raise ValueError(f'Can only have a standalone HTML component in name: {elems!r}')
-            node = elems[0]
-            # FIXME this is probably not the right way to override things. Need
-            # to determine a better default policy - and make it configurable
-            # for any given node supporting the HTML protocol
-            return type(node)(node.tag, node.attrs | attrs, node.children + children)
-        else:
-            tag = ''.join(elems)
+                raise TypeError(f'Expected HTML, callable, str, or int, got {value!r}')
+
+    def fill_tag(self, tag: Parts, attrs, children) -> HTML:
+        return make_tag(self.fill(tag, self.convert_name), attrs, children)
+
+    def interpolate(self, root: AstNode) -> HTML:
+        # Nodes are built in post-order, using an explicit stack of
+        # (node, remaining children, filled children) instead of recursion,
+        # so arbitrarily deep templates can be filled
+        stack = [(root, iter(root.children), [])]
+        while True:
+            tag, remaining, children = stack[-1]
+            for child in remaining:
+                match child:
+                    case AstNode() as node:
+                        stack.append((node, iter(node.children), []))
+                        break
+                    case str() as s:
+                        children.append(s)
+                    case int() as i:
+                        children.extend(self.convert_child(self.args[i].getvalue()))
+            else:
+                stack.pop()
+                attrs = {}
+                for k, v in tag.attrs:
+                    attrs |= self.fill_attr(k, v)
+                node = self.fill_tag(tag.tag, attrs or EMPTY_ATTRS, children or EMPTY_CHILDREN)
+                if not stack:
+                    return node
+                stack[-1][2].append(node)
+
+
+# Compiles the AST into a Python function that directly builds the HtmlNode
+# tree. Static parts of the template are resolved at compile time, so that the
+# generated code only looks up args by position and converts their values:
+#
+#   <div title={title}>Hello {name}</div>
+#
+# becomes
+#
+#   def compiled(args, /):
+#       n0 = HtmlNode('div', ({'title': require_one_value([*convert_attr_value(args[1].getvalue())])} or EMPTY_ATTRS), ['Hello ', *convert_child(args[3].getvalue())])
+#       return n0
+#
+# Nodes are assigned to locals in post-order, so the generated code is flat
+# and does not nest expressions for nested tags.
+
+class TemplateCompiler:
+    def __init__(self):
+        self.lines = ['def compiled(args, /):']
+        self.count = 0
+        self.constants: dict[str, Markup] = {}
+
+    @property
+    def code(self) -> str:
+        return '\n'.join(self.lines)
+
+    def compile(self, root: AstNode, lazy: bool = False) -> Callable[[Sequence[str | Interpolation]], HTML]:
+        self.lines.append(f'    return {self.add_node(root)}')
+        code_obj = compile(self.code, '<htm template>', 'exec')
+        captured = dict(_compiled_globals) | self.constants
+        if lazy:
+            captured['convert_child'] = _lazy_converters.convert_child
+        exec(code_obj, captured)
+        return captured['compiled']
+
+    def add_node(self, root: AstNode) -> str:
+        # Same post-order traversal as Fill.interpolate
+        stack = [(root, iter(root.children), [])]
+        while True:
+            node, remaining, children = stack[-1]
+            for child in remaining:
+                match child:
+                    case AstNode():
+                        stack.append((child, iter(child.children), []))
+                        break
+                    case Markup() as m:
+                        # Hoisted static subtree, see hoist_static
+                        name = f'm{len(self.constants)}'
+                        self.constants[name] = m
+                        children.append(name)
+                    case str() as s:
+                        children.append(repr(s))
+                    case int() as i:
+                        children.append(f'*convert_child(args[{i}].getvalue())')
+            else:
+                stack.pop()
+                attrs = self.attrs(node.attrs)
+                name = f'n{self.count}'
+                self.count += 1
+                self.lines.append(f'    {name} = {self.tag(node.tag, attrs, self.children(children))}')
+                if not stack:
+                    return name
+                stack[-1][2].append(name)
+
+    def elems(self, parts: Parts, convert: str) -> str:
+        # Equivalent to Fill.fill for these parts, as code
+        if isinstance(parts, str):
+            return f'[{parts!r}]'
+        elems = []
+        for part in parts:
+            match part:
+                case str():
+                    elems.append(repr(part))
+                case int() as i:
+                    elems.append(f'*{convert}(args[{i}].getvalue())')
+        return f'[{', '.join(elems)}]'
+
+    def children(self, children: list[str]) -> str:
+        if not children:
+            return 'EMPTY_CHILDREN'
+        elif all(child.startswith('*') for child in children):
+            return f'([{', '.join(children)}] or EMPTY_CHILDREN)'
+        return f'[{', '.join(children)}]'
+
+    def attrs(self, attrs: list[tuple[Parts, Parts | None]]) -> str:
+        if not attrs:
+            return 'EMPTY_ATTRS'
+        code = []
+        static = {}
+        for k, v in attrs:
+            if isinstance(k, str) and (v is None or isinstance(v, str)):
+                static |= {k: True if v is None else v}
+                continue
+            if static or (not code and v is None):
+                # Starting with a dict display also ensures that a splatted
+                # dict is copied, as with Fill.interpolate
+                code.append(repr(static))
+                static = {}
+            if v is None:
+                code.append(f'flag_attr({self.elems(k, "convert_attr_value")})')
+            else:
+                key = repr(k) if isinstance(k, str) else f'require_one_value({self.elems(k, "convert_attr_key")})'
+                code.append(f'{{{key}: require_one_value({self.elems(v, "convert_attr_value")})}}')
+        if not code:
+            return repr(static)
+        if static:
+            code.append(repr(static))
+        return f'({' | '.join(code)} or EMPTY_ATTRS)'
+
+    def tag(self, tag: Parts, attrs: str, children: str) -> str:
+        if isinstance(tag, str):
+            # Validate now, since this can't change from call to call
             if not valid_tagname_re.match(tag):
                 raise ValueError(f'Not a valid tag: {tag}')
-            return HtmlNode(tag, attrs, children)
+            return f'HtmlNode({tag!r}, {attrs}, {children})'
+        return f'make_tag({self.elems(tag, "convert_name")}, {attrs}, {children})'
+
+
+_converters = Fill(())
+_lazy_converters = Fill((), lazy=True)
+_compiled_globals = {
+    'HtmlNode': HtmlNode,
+    'EMPTY_ATTRS': EMPTY_ATTRS,
+    'EMPTY_CHILDREN': EMPTY_CHILDREN,
+    'make_tag': make_tag,
+    'flag_attr': flag_attr,
+    'require_one_value': require_one_value,
+    'convert_child': _converters.convert_child,
+    'convert_attr_key': _converters.convert_attr_key,
+    'convert_attr_value': _converters.convert_attr_value,
+    'convert_name': _converters.convert_name,
+}
+
+
+# Static subtrees, without any interpolations, render the same on every call,
+# so these can be rendered once and spliced in as Markup. The root is always
+# kept as a node, as are the children of components, which may inspect them.
+
+def is_static_tag(node: AstNode) -> bool:
+    return isinstance(node.tag, str) and all(
+        isinstance(k, str) and (v is None or isinstance(v, str)) for k, v in node.attrs)
 
-    def interpolate(self, tag: AstNode) -> HTML:
-        children = []
-        for child in tag.children:
+
+def render_static(node: AstNode) -> Markup:
+    return Markup(str(_converters.interpolate(node)))
+
+
+def hoist_static(root: AstNode) -> AstNode:
+    """Returns a copy of the AST with maximal static subtrees rendered to Markup"""
+    static = set()  # ids of static nodes, which are all kept alive by root
+    stack = [[root, iter(root.children), [], is_static_tag(root)]]
+    while True:
+        frame = stack[-1]
+        node, remaining, children, _ = frame
+        for child in remaining:
             match child:
-                case AstNode() as node:
-                    children.append(self.interpolate(node))
-                case str() as s:
-                    children.extend(self.fill(s, self.convert_child))
+                case AstNode():
+                    stack.append([child, iter(child.children), [], is_static_tag(child)])
+                    break
+                case int():
+                    frame[3] = False
+                    children.append(child)
+                case str():
+                    children.append(child)
+        else:
+            stack.pop()
+            is_static = frame[3]
+            if is_static:
+                static.add(id(node))
+            if stack and is_static:
+                # Unchanged, and possibly part of a larger static subtree
+                copied = node
+            else:
+                if isinstance(node.tag, str):
+                    children = [
+                        render_static(child) if isinstance(child, AstNode) and id(child) in static else child
+                        for child in children
+                    ]
+                copied = AstNode(node.tag, node.attrs, children)
+            if not stack:
+                return copied
+            stack[-1][2].append(copied)
+            if not is_static:
+                stack[-1][3] = False
+
+
+@dataclass
+class ParsedTemplate:
+    ast: AstNode
+    hoisted: AstNode | None = None
+    codes: dict[tuple[bool, bool], Callable[[Sequence[str | Interpolation]], HTML]] = field(default_factory=dict)
+
+    def get_ast(self, hoist: bool = False) -> AstNode:
+        if not hoist:
+            return self.ast
+        if self.hoisted is None:
+            self.hoisted = hoist_static(self.ast)
+        return self.hoisted
 
-        attrs = {}
-        for k, v in tag.attrs:
-            attrs |= self.fill_attr(k, v)
+    def compiled(self, lazy: bool = False, hoist: bool = False) -> Callable[[Sequence[str | Interpolation]], HTML]:
+        code = self.codes.get((lazy, hoist))
+        if code is None:
+            code = self.codes[lazy, hoist] = TemplateCompiler().compile(self.get_ast(hoist), lazy)
+        return code
 
-        return self.fill_tag(tag.tag, attrs, children)
+    def child_indexes(self) -> set[int]:
+        """Indexes of the interpolations used as children, not in tags"""
+        indexes = set()
+        stack = [self.ast]
+        while stack:
+            for child in stack.pop().children:
+                match child:
+                    case int() as i:
+                        indexes.add(i)
+                    case AstNode() as node:
+                        stack.append(node)
+        return indexes
 
 
-def html(template: Template) -> HTML:
+# Parsed templates, keyed on their static parts: the strings, plus the
+# expression text of each interpolation, since end tags such as </h{level}>
+# are checked against the start tag by expression. Only the values change from
+# call to call, and these are filled in on every call. Cached ASTs are shared
+# and must not be mutated.
+
+_template_cache = LRUCache(maxsize=256)
+
+
+def template_key(args: Sequence[str | Interpolation]) -> tuple:
+    return tuple(
+        arg if isinstance(arg, str) else (arg.expr, arg.conv, arg.format_spec)
+        for arg in args
+    )
+
+
+def parse(args: Sequence[str | Interpolation]) -> AstNode:
     parser = AstParser()
-    for arg in template.args:
+    for arg in args:
         parser.feed(arg)
-    return Fill(template.args).interpolate(parser.result())
+    return parser.result()
+
+
+def cache_info() -> CacheInfo:
+    return _template_cache.info()
+
+
+def cache_clear() -> None:
+    _template_cache.clear()
+
+
+def set_cache_size(maxsize: int | None) -> None:
+    """Bounds the number of parsed templates kept; None means unbounded"""
+    _template_cache.resize(maxsize)
+
+
+def get_parsed(args: Sequence[str | Interpolation]) -> ParsedTemplate:
+    return _template_cache.get_or_create(template_key(args), lambda: ParsedTemplate(parse(args)))
+
+
+def fill_args(
+        args: Sequence[str | Interpolation],
+        compiled: bool = False, lazy: bool = False, hoist: bool = False) -> HTML:
+    parsed = get_parsed(args)
+    if compiled:
+        return parsed.compiled(lazy, hoist)(args)
+    return Fill(args, lazy).interpolate(parsed.get_ast(hoist))
+
+
+def html(template: Template, *, compiled: bool = False, lazy: bool = False, hoist: bool = False) -> HTML:
+    """Builds an HtmlNode tree from the template.
+
+    With compiled=True, the template is compiled into Python code on first
+    use (see TemplateCompiler), instead of walking the AST on every call.
+
+    With lazy=True, iterables such as generators are kept as LazyChildren,
+    and only consumed while rendering with iter_render or render_to.
+
+    With hoist=True, static subtrees are rendered once, when first used, and
+    then included as Markup children instead of HtmlNodes.
+    """
+    return fill_args(template.args, compiled, lazy, hoist)
+
+
+# Async support. Interpolated values may be awaitables, which are awaited, or
+# async iterables, which are collected into a list. These are all resolved
+# concurrently.
+
+@dataclass(slots=True)
+class Pending:
+    """A child that is still being resolved, see aiter_render"""
+    future: asyncio.Future
+
+
+def is_async(value: Any) -> bool:
+    return inspect.isawaitable(value) or isinstance(value, AsyncIterable)
+
+
+async def resolve_value(value: Any) -> Any:
+    if inspect.isawaitable(value):
+        value = await value
+    if isinstance(value, AsyncIterable):
+        return [item async for item in value]
+    return value
+
+
+def resolved_args(
+        args: Sequence[str | Interpolation], values: dict[int, Any]) -> list[str | Interpolation]:
+    # Equivalent args, except that getvalue returns the resolved value
+    return [
+        InterpolationConcrete(lambda value=values[i]: value, arg.expr, arg.conv, arg.format_spec)
+        if i in values else arg
+        for i, arg in enumerate(args)
+    ]
+
+
+def get_values(args: Sequence[str | Interpolation]) -> dict[int, Any]:
+    return {i: arg.getvalue() for i, arg in enumerate(args) if not isinstance(arg, str)}
+
+
+async def ahtml(template: Template, *, compiled: bool = False, lazy: bool = False, hoist: bool = False) -> HTML:
+    """Like html, but first resolves any async values, concurrently"""
+    args = template.args
+    values = get_values(args)
+    pending = [i for i, value in values.items() if is_async(value)]
+    resolved = await asyncio.gather(*(resolve_value(values[i]) for i in pending))
+    values.update(zip(pending, resolved))
+    return fill_args(resolved_args(args, values), compiled, lazy, hoist)
+
+
+async def aiter_render(template: Template, *, lazy: bool = False, hoist: bool = False) -> AsyncIterator[str]:
+    """Renders the template, resolving any async values concurrently.
+
+    Rendered HTML is yielded in chunks, as soon as it is complete up to the
+    next child that is still being resolved. Async values in tags, such as
+    attribute values, are resolved before rendering starts. See html for the
+    lazy and hoist options.
+    """
+    args = template.args
+    parsed = get_parsed(args)
+    values = get_values(args)
+    tasks = {
+        i: asyncio.ensure_future(resolve_value(value))
+        for i, value in values.items() if is_async(value)
+    }
+    try:
+        child_indexes = parsed.child_indexes()
+        for i, task in tasks.items():
+            values[i] = Pending(task) if i in child_indexes else await task
+        converters = Fill(resolved_args(args, values), lazy)
+        node = converters.interpolate(parsed.get_ast(hoist))
+
+        chunk = []
+        for fragment in iter_render(node):
+            if isinstance(fragment, Pending):
+                if chunk and not fragment.future.done():
+                    yield ''.join(chunk)
+                    chunk = []
+                value = await fragment.future
+                chunk.extend(iter_render_children(converters.convert_child(value)))
+            else:
+                chunk.append(fragment)
+        if chunk:
+            yield ''.join(chunk)
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+
+# Components, as used in <{Component} title="...">...</{Component}>, are
+# called with the children and attrs of that tag. Components which render the
+# same output for the same inputs, such as site headers and footers, can be
+# memoized with @cached_component.
+
+_component_caches: WeakSet[LRUCache] = WeakSet()
+
+
+def typed_key(value: Any) -> tuple:
+    # Equal values of different types, such as Markup('<b>') and '<b>', or
+    # True and 1, can render differently, so must not share a cache entry
+    if type(value) is tuple:
+        return (tuple, tuple(typed_key(item) for item in value))
+    return (type(value), value)
+
+
+def component_key(children: tuple, attrs: dict) -> tuple | None:
+    # Attrs order does not matter when calling the component
+    key = (
+        typed_key(children),
+        tuple((name, typed_key(value)) for name, value in sorted(attrs.items(), key=itemgetter(0))),
+    )
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def cached_component(
+    func: Callable[..., HTML] | None = None,
+    /, *,
+    maxsize: int | None = 128,
+    ttl: float | None = None,
+    serialize: bool = False,
+) -> Callable:
+    """Memoizes a component on its children and attrs.
+
+    Calls with any unhashable children or attrs (such as HtmlNode children)
+    are not cached. If ttl is given, rendered results expire after that many
+    seconds. With serialize=True, the rendered string is cached as Markup,
+    instead of the HtmlNode tree.
+
+    The decorated component has cache_info(), cache_clear(), and
+    cache_invalidate(*children, **attrs) to remove a single entry;
+    clear_component_caches() clears all cached components.
+    """
+    def decorator(func: Callable[..., HTML]) -> Callable[..., HTML | Markup]:
+        cache = LRUCache(maxsize, ttl=ttl)
+        _component_caches.add(cache)
+
+        def render(children, attrs):
+            node = func(*children, **attrs)
+            return Markup(str(node)) if serialize else node
+
+        @wraps(func)
+        def component(*children, **attrs):
+            key = component_key(children, attrs)
+            if key is None:
+                return render(children, attrs)
+            return cache.get_or_create(key, lambda: render(children, attrs))
+
+        def cache_invalidate(*children, **attrs) -> bool:
+            key = component_key(children, attrs)
+            return key is not None and cache.discard(key)
+
+        component.cache = cache
+        component.cache_info = cache.info
+        component.cache_clear = cache.clear
+        component.cache_invalidate = cache_invalidate
+        return component
+
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+def clear_component_caches() -> None:
+    for cache in list(_component_caches):
+        cache.clear()
 
 
 if __name__ == "__main__":
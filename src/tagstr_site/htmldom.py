@@ -1,12 +1,16 @@
 from __future__ import annotations
 
+import re
 from typing import *
-from textwrap import dedent
+from os.path import commonprefix
 from collections.abc import Sequence
 from dataclasses import dataclass, field
+from functools import wraps
 from html import escape
 from html.parser import HTMLParser
 
+from tagstr_site.htm import component_key
+from tagstr_site.lru import CacheInfo, LRUCache
 from tagstr_site.taglib import decode_raw, format_value
 from tagstr_site.tagtyping import Decoded as Thunk
 
@@ -39,11 +43,13 @@ def demo2():
     print(result)
 
 
-def html(*args: str | Thunk) -> str:
-    parser = HtmlNodeParser()
-    for arg in decode_raw(*args):
-        parser.feed(arg)
-    return parser.result()
+def html(*args: str | Thunk) -> HtmlNode:
+    return prepare(*args).bind([get_value(arg) for arg in args if not isinstance(arg, str)])
+
+
+def get_value(arg: Thunk) -> Any:
+    _, _, conv, spec = arg
+    return format_value(arg) if (conv or spec) else arg[0]()
 
 
 HtmlChildren = list[str, "HtmlNode"]
@@ -56,159 +62,288 @@ class HtmlNode:
     attributes: HtmlAttributes = field(default_factory=dict)
     children: HtmlChildren = field(default_factory=list)
 
-    def render(self) -> HtmlNode:
+    def render(self) -> ResolvedNode:
+        """Resolves the tree, calling each component exactly once"""
         if callable(self.tag):
             return self.tag(*self.children, **self.attributes).render()
         else:
-            return HtmlNode(
+            return ResolvedNode(
                 self.tag,
                 self.attributes,
                 [c.render() if isinstance(c, HtmlNode) else c for c in self.children],
             )
 
     def __str__(self) -> str:
-        node = self.render()
-
-        attribute_list: list[str] = []
-        for key, value in node.attributes.items():
-            match key, value:
-                case _, True:
-                    attribute_list.append(f" {key}")
-                case _, False | None:
-                    pass
-                case "style", style:
-                    if not isinstance(style, dict):
-                        raise TypeError("Expected style attribute to be a dictionary")
-                    css_string = escape("; ".join(f"{k}:{v}" for k, v in style.items()))
-                    attribute_list.append(f' style="{css_string}"')
-                case _:
-                    attribute_list.append(f' {key}="{escape(str(value))}"')
+        return str(self.render())
+
+
+@dataclass
+class ResolvedNode:
+    """An HtmlNode tree after calling its components, which can be rendered
+    to a string without resolving again. May be shared by memoized
+    components, so treat it as immutable."""
+    tag: str = ""
+    attributes: HtmlAttributes = field(default_factory=dict)
+    children: list[str, "ResolvedNode"] = field(default_factory=list)
+
+    def render(self) -> ResolvedNode:
+        return self
 
-        children_list: list[str] = []
-        for item in node.children:
+    def __str__(self) -> str:
+        out: list[str] = []
+        self.render_into(out)
+        return "".join(out)
+
+    def render_into(self, out: list[str]) -> None:
+        """Appends the HTML to out, so the whole tree is joined only once"""
+        if not self.tag:
+            if self.attributes:
+                raise ValueError("Untagged node cannot have attributes.")
+        else:
+            out.append(f"<{self.tag}")
+            for key, value in self.attributes.items():
+                match key, value:
+                    case _, True:
+                        out.append(f" {key}")
+                    case _, False | None:
+                        pass
+                    case "style", style:
+                        if not isinstance(style, dict):
+                            raise TypeError("Expected style attribute to be a dictionary")
+                        css_string = escape("; ".join(f"{k}:{v}" for k, v in style.items()))
+                        out.append(f' style="{css_string}"')
+                    case _:
+                        out.append(f' {key}="{escape(str(value))}"')
+            out.append(">")
+
+        for item in self.children:
             match item:
                 case "":
                     pass
                 case str():
-                    item = escape(item, quote=False)
-                case HtmlNode():
-                    item = str(item)
+                    out.append(escape(item, quote=False))
+                case ResolvedNode():
+                    item.render_into(out)
                 case _:
-                    item = str(item)
-            children_list.append(item)
+                    out.append(str(item))
 
-        body = "".join(children_list)
+        if self.tag:
+            out.append(f"</{self.tag}>")
+
+
+def memo_component(
+    func: Callable[..., HtmlNode] | None = None, /, *, maxsize: int | None = 128
+) -> Callable:
+    """Memoizes the resolved tree of a component, keyed on its children and
+    attributes. Calls with unhashable children or attributes, such as
+    HtmlNodes, are not cached.
+
+    The decorated component has cache_info() and cache_clear().
+    """
+    def decorator(func: Callable[..., HtmlNode]) -> Callable[..., ResolvedNode]:
+        cache = LRUCache(maxsize)
+
+        @wraps(func)
+        def component(*children, **attributes) -> ResolvedNode:
+            key = component_key(children, attributes)
+            if key is None:
+                return func(*children, **attributes).render()
+            return cache.get_or_create(key, lambda: func(*children, **attributes).render())
+
+        component.cache_info = cache.info
+        component.cache_clear = cache.clear
+        return component
+
+    if func is not None:
+        return decorator(func)
+    return decorator
 
-        if not node.tag:
-            if node.attributes:
-                raise ValueError("Untagged node cannot have attributes.")
-            result = body
-        else:
-            attr_body = "".join(attribute_list)
-            result = f"<{node.tag}{attr_body}>{body}</{node.tag}>"
 
-        return dedent(result)
+# A template is parsed once into a tree of TemplateNodes, where each
+# interpolation is replaced by its slot number. Binding values to the slots
+# then builds an HtmlNode tree, without parsing again.
 
+Parts = str | int | tuple[str | int, ...]
 
-class HtmlNodeParser(HTMLParser):
+
+@dataclass
+class TemplateNode:
+    tag: Parts = ""
+    attributes: list[tuple[Parts, Parts | None]] = field(default_factory=list)
+    children: list[str | int | TemplateNode] = field(default_factory=list)
+    end_tag: Parts | None = None
+
+    def bind(self, values: Sequence[Any]) -> HtmlNode:
+        tag = join_parts(self.tag, values)
+
+        node_attrs = {}
+        for k, v in self.attributes:
+            if v is not None:
+                node_attrs[k] = join_parts(v, values)
+            elif isinstance(k, int):
+                node_attrs.update(values[k])
+            else:
+                node_attrs[k] = True
+
+        children = []
+        for child in self.children:
+            match child:
+                case TemplateNode():
+                    children.append(child.bind(values))
+                case str():
+                    children.append(child)
+                case int():
+                    match value := values[child]:
+                        case "":
+                            pass
+                        case str():
+                            children.append(value)
+                        case Sequence():
+                            children.extend(value)
+                        case _:
+                            children.append(value)
+
+        if not (self.end_tag is None or (isinstance(self.end_tag, str) and isinstance(self.tag, str))):
+            end_tag = join_parts(self.end_tag, values)
+            # ... is the end tag shorthand
+            if end_tag is not ... and end_tag != tag:
+                raise SyntaxError(f"Start tag {tag!r} does not match end tag {end_tag!r}")
+
+        return HtmlNode(tag, node_attrs, children)
+
+
+@dataclass
+class PreparedTemplate:
+    root: TemplateNode
+    slots: int
+
+    def bind(self, values: Sequence[Any]) -> HtmlNode:
+        """Builds the HtmlNode tree, with values in the same order as the interpolations"""
+        if len(values) != self.slots:
+            raise ValueError(f"Expected {self.slots} values, got {len(values)}")
+        root = self.root.bind(values)
+        match root.children:
+            case []:
+                raise ValueError("Nothing to return")
+            case [child]:
+                return child
+            case _:
+                return root
+
+
+class TemplateParser(HTMLParser):
     def __init__(self):
         super().__init__()
-        self.root = HtmlNode()
+        self.root = TemplateNode()
         self.stack = [self.root]
-        self.values: list[Any] = []
+        self.slots = 0
 
     def feed(self, data: str | Thunk) -> None:
         match data:
             case str():
                 super().feed(escape_placeholder(data))
-            case getvalue, _, conv, spec:
-                value = getvalue()
-                self.values.append(
-                    format_value(value, conv, spec) if (conv or spec) else value
-                )
-                super().feed(PLACEHOLDER)
-
-    def result(self) -> HtmlNode:
-        root = self.root
-        self.close()
-        match root.children:
-            case []:
-                raise ValueError("Nothing to return")
-            case [child]:
-                return child
             case _:
-                return self.root
+                super().feed(placeholder(self.slots))
+                self.slots += 1
 
-    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
-        tag, self.values = join_with_values(tag, self.values)
+    def result(self) -> PreparedTemplate:
+        self.close()
+        normalize_whitespace(self.root)
+        return PreparedTemplate(self.root, self.slots)
 
-        node_attrs = {}
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        node_attrs = []
         for k, v in attrs:
-            if k == PLACEHOLDER and v is None:
-                expansion_value, *self.values = self.values
-                node_attrs.update(expansion_value)
-            elif PLACEHOLDER in k:
+            k = to_parts(k)
+            if not isinstance(k, str) and not (isinstance(k, int) and v is None):
                 raise SyntaxError("Cannot interpolate attribute names")
-            elif v == PLACEHOLDER:
-                interpolated_value, *self.values = self.values
-                node_attrs[k] = interpolated_value
-            else:
-                interpolated_value, self.values = join_with_values(v, self.values)
-                node_attrs[k] = interpolated_value
-
-        # At this point all interpolated values should have been consumed.
-        assert not self.values, "Did not interpolate all values"
+            node_attrs.append((k, None if v is None else to_parts(v)))
 
-        this_node = HtmlNode(tag, node_attrs)
-        last_node = self.stack[-1]
-        last_node.children.append(this_node)
+        this_node = TemplateNode(to_parts(tag), node_attrs)
+        self.stack[-1].children.append(this_node)
         self.stack.append(this_node)
 
     def handle_data(self, data: str) -> None:
-        interleaved_children, self.values = interleave_with_values(data, self.values)
-
-        # At this point all interpolated values should have been consumed.
-        assert not self.values, "Did not interpolate all values"
-
+        # Data can be split across calls, so merge with any preceding text
         children = self.stack[-1].children
-        for child in interleaved_children:
-            match child:
-                case "":
-                    pass
-                case str():
-                    children.append(child)
-                case Sequence():
-                    children.extend(child)
-                case _:
-                    children.append(child)
+        for part in split_slots(data):
+            if isinstance(part, str) and children and isinstance(children[-1], str):
+                children[-1] += part
+            else:
+                children.append(part)
 
     def handle_endtag(self, tag: str) -> None:
         node = self.stack.pop()
+        node.end_tag = to_parts(tag)
+        if isinstance(node.tag, str) and isinstance(node.end_tag, str) and node.tag != node.end_tag:
+            raise SyntaxError(f"Start tag {node.tag!r} does not match end tag {node.end_tag!r}")
+
+
+# Templates are usually indented to match the surrounding code, as in
+#
+#   html(t"""
+#       <div>...</div>
+#   """)
+#
+# so as with textwrap.dedent, lines that are only whitespace are made empty,
+# and any whitespace common to the start of every other line is removed. This
+# is done once, when parsing, for the text of the template itself; unlike
+# dedent on the rendered output, interpolated values are not considered.
+
+def normalize_whitespace(root: TemplateNode) -> None:
+    # Text in document order; None stands for anything else, such as a tag
+    texts: list[tuple[list, int] | None] = []
+
+    def collect(node: TemplateNode) -> None:
+        for i, child in enumerate(node.children):
+            if isinstance(child, str):
+                texts.append((node.children, i))
+            else:
+                texts.append(None)
+                if isinstance(child, TemplateNode):
+                    collect(child)
+                    texts.append(None)
+
+    collect(root)
+
+    indents = []
+    lines_by_text = []
+    for n, text in enumerate(texts):
+        if text is None:
+            if n == 0:
+                indents.append("")
+            continue
+        children, i = text
+        lines = children[i].split("\n")
+        for k, line in enumerate(lines):
+            if k == 0 and n > 0:
+                continue  # continues the line of whatever came before
+            content = line.lstrip(" \t")
+            if not content and (k < len(lines) - 1 or n == len(texts) - 1):
+                lines[k] = ""
+            else:
+                indents.append(line[:len(line) - len(content)])
+        lines_by_text.append((children, i, n, lines))
 
-        if tag == PLACEHOLDER:
-            interp_tag, *self.values = self.values
-        else:
-            interp_tag, self.values = join_with_values(tag, self.values)
-
-        # At this point all interpolated values should have been consumed.
-        assert not self.values, "Did not interpolate all values"
-
-        if interp_tag is ...:
-            # handle end tag shorthand
-            return None
-
-        if interp_tag != node.tag:
-
-            raise SyntaxError(
-                "Start tag {node.tag!r} does not match end tag {interp_tag!r}"
-            )
+    margin = commonprefix(indents)
+    for children, i, n, lines in lines_by_text:
+        if margin:
+            lines = [
+                line.removeprefix(margin) if (k > 0 or n == 0) else line
+                for k, line in enumerate(lines)
+            ]
+        children[i] = "\n".join(lines)
 
 
 # We choose this symbol because, after replacing all $ with $$, there is no way for a
-# user to feed a string that would result in x$x. Thus we can reliably split an HTML
-# data string on x$x. We also choose this because, the HTML parse looks for tag names
+# user to feed a string that would result in x$Nx. Thus we can reliably split an HTML
+# data string on x$Nx. We also choose this because, the HTML parse looks for tag names
 # begining with the regex pattern '[a-zA-Z]'.
-PLACEHOLDER = "x$x"
+PLACEHOLDER_RE = re.compile(r"x\$(\d+)x")
+
+
+def placeholder(slot: int) -> str:
+    return f"x${slot}x"
 
 
 def escape_placeholder(string: str) -> str:
@@ -219,32 +354,60 @@ def unescape_placeholder(string: str) -> str:
     return string.replace("$$", "$")
 
 
-def join_with_values(string: str, values: list[Any]) -> tuple[str, list[Any]]:
-    interleaved_values, remaining_values = interleave_with_values(string, values)
-    match interleaved_values:
-        case [value]:
-            return value, remaining_values
-        case values:
-            return "".join(map(str, values)), remaining_values
+def split_slots(string: str) -> list[str | int]:
+    parts = []
+    for i, part in enumerate(PLACEHOLDER_RE.split(string)):
+        if i % 2:
+            parts.append(int(part))
+        elif part:
+            parts.append(unescape_placeholder(part))
+    return parts
 
 
-def interleave_with_values(
-    string: str, values: list[Any]
-) -> tuple[list[Any], list[Any]]:
-    if string == PLACEHOLDER:
-        return values[:1], values[1:]
+def to_parts(string: str) -> Parts:
+    match split_slots(string):
+        case []:
+            return ""
+        case [part]:
+            return part
+        case parts:
+            return tuple(parts)
 
-    *string_parts, last_string_part = string.split(PLACEHOLDER)
-    remaining_values = values[len(string_parts) :]
 
-    interleaved_values = [
-        item
-        for s, v in zip(string_parts, values)
-        for item in (unescape_placeholder(s), v)
-    ]
-    interleaved_values.append(last_string_part)
+def join_parts(parts: Parts, values: Sequence[Any]) -> Any:
+    match parts:
+        case str():
+            return parts
+        case int():
+            return values[parts]
+        case _:
+            return "".join(part if isinstance(part, str) else str(values[part]) for part in parts)
+
+
+# Prepared templates, keyed on the static strings. The values are bound on
+# every call.
+
+_template_cache = LRUCache(maxsize=256)
+
+
+def prepare(*args: str | Thunk) -> PreparedTemplate:
+    key = tuple(arg if isinstance(arg, str) else None for arg in args)
+    return _template_cache.get_or_create(key, lambda: parse(*args))
+
+
+def parse(*args: str | Thunk) -> PreparedTemplate:
+    parser = TemplateParser()
+    for arg in decode_raw(*args):
+        parser.feed(arg)
+    return parser.result()
+
+
+def cache_info() -> CacheInfo:
+    return _template_cache.info()
+
 
-    return interleaved_values, remaining_values
+def cache_clear() -> None:
+    _template_cache.clear()
 
 
 if __name__ == "__main__":
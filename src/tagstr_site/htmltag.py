@@ -7,26 +7,54 @@
 
 from __future__ import annotations
 
-import re
-from functools import cache
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
 from html.parser import HTMLParser
+from pathlib import Path
+from operator import itemgetter
 from types import CodeType
+from weakref import WeakKeyDictionary
 from typing import *
 
-from tagstr_site.taglib import decode_raw
+from tagstr_site.htm import render_class, render_style, valid_attribute_name_re, valid_tagname_re
+from tagstr_site.htmldom import (
+    PLACEHOLDER_RE, escape_placeholder, placeholder, split_slots, unescape_placeholder)
+from tagstr_site.lru import CacheInfo, LRUCache
+from tagstr_site.taglib import Markup, decode_raw, escape_html
 from tagstr_site.tagtyping import Decoded, Interpolation
 
 
-ENDS_WITH_WHITESPACE_RE = re.compile(r'\s+$')
-ENDS_WITH_ATTRIBUTE_KEY_RE = re.compile(r'\s+(\S+)\=$')
+# Changes whenever DomCodeGenerator generates different code for the same
+# template, so that code cached on disk is not reused
+GENERATOR_VERSION = 3
+
+CONVERSIONS = {'a': 'ascii', 'r': 'repr', 's': 'str'}
+
+VOID_ELEMENTS = frozenset({
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+    'source', 'track', 'wbr',
+})
 
 
 class DomCodeGenerator(HTMLParser):
-    """Given HTML input with interpolations, generates code to build an equivalent DOM"""
+    """Given HTML input with interpolations, generates code to build an equivalent DOM
+
+    Interpolations are fed to the parser as numbered placeholders, see
+    htmldom, so that they can be used anywhere: in the data for some tag, as
+    splatted in attributes (<tag {attrs}>), as or in attribute keys and values,
+    quoted or not, and as or in the tag name. End tags must then match the
+    start tag, with interpolations at the same positions.
+    """
+    globals = {}
+
     def __init__(self):
         self.lines = ['def compiled(vdom, /, *args):', '  return \\']
-        self.tag_interpolations = []
         self.tag_stack = []
+        self.root_closed = False
+        self.formats: dict[int, tuple[str | None, str | None]] = {}
         super().__init__()
 
     def indent(self) -> str:
@@ -36,18 +64,85 @@ class DomCodeGenerator(HTMLParser):
     def code(self) -> str:
         return '\n'.join(self.lines)
 
+    def feed(self, data: str) -> None:
+        super().feed(escape_placeholder(data))
+
+    def add_interpolation(self, i: int, conv: str | None = None, spec: str | None = None):
+        # The convention used here in the codegen is that the code
+        # `args[{i}][0]()` calls getvalue for the interpolation at the i-th
+        # position in args. Conversion and format spec are applied by the
+        # generated code as well, see value.
+        if conv is not None and conv not in CONVERSIONS:
+            raise ValueError(f'Bad conversion: {conv!r}')
+        self.formats[i] = conv, spec
+        super().feed(placeholder(i))
+
+    def value(self, i: int) -> str:
+        code = f'args[{i}][0]()'
+        conv, spec = self.formats[i]
+        if conv:
+            code = f'{CONVERSIONS[conv]}({code})'
+        if spec:
+            code = f'format({code}, {spec!r})'
+        return code
+
+    def join(self, string: str) -> str:
+        """Code for string as a value, with any interpolations in it"""
+        match split_slots(string):
+            case []:
+                return "''"
+            case [str() as s]:
+                return repr(s)
+            case [int() as i]:
+                return self.value(i)
+            case parts:
+                return ' + '.join(
+                    repr(part) if isinstance(part, str) else f'str({self.value(part)})' for part in parts)
+
     def handle_starttag(self, tag, attrs):
-        attrs_code = [f'{dict(attrs)!r}']
-        attrs_code.extend(self.tag_interpolations)
-        self.tag_interpolations = []
-        self.lines.append(f"{self.indent()}vdom('{tag}', {'|'.join(attrs_code)}, [")
+        # Later attributes win, as with a dict display, so static attributes
+        # are only grouped together until an interpolated one
+        attrs_code = []
+        static = {}
+        for k, v in attrs:
+            key = split_slots(k)
+            if all(isinstance(part, str) for part in key) and (v is None or not PLACEHOLDER_RE.search(v)):
+                static[unescape_placeholder(k)] = v if v is None else unescape_placeholder(v)
+                continue
+            if static:
+                attrs_code.append(repr(static))
+                static = {}
+            match key, v:
+                case [int() as i], None:
+                    attrs_code.append(self.value(i))
+                case _, None:
+                    attrs_code.append(f'{{{self.join(k)}: None}}')
+                case _:
+                    attrs_code.append(f'{{{self.join(k)}: {self.join(v)}}}')
+        if self.root_closed:
+            raise RuntimeError(f'unexpected <{tag}> after the root element')
+        if static or not attrs_code:
+            attrs_code.append(repr(static))
+        self.lines.append(f"{self.indent()}vdom({self.join(tag)}, {' | '.join(attrs_code)}, [")
         self.tag_stack.append(tag)
+        if tag in VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.handle_endtag(tag)
 
     def handle_endtag(self, tag):
-        if tag != self.tag_stack[-1]:
+        if not self.tag_stack:
+            raise RuntimeError(f'unexpected </{tag}>')
+        if tag in VOID_ELEMENTS and self.tag_stack[-1] != tag:
+            return  # already closed
+        if tag_shape(tag) != tag_shape(self.tag_stack[-1]):
             raise RuntimeError(f'unexpected </{tag}>')
         self.tag_stack.pop()
         self.lines.append(f'{self.indent()}]){"," if self.tag_stack else ""}')
+        self.root_closed = not self.tag_stack
 
     def handle_data(self, data: str):
         # At the very least the first empty line needs to be removed, as might
@@ -60,104 +155,355 @@ class DomCodeGenerator(HTMLParser):
         # Arguably other blank strings should be removed as well, and this
         # stripping results in having output equivalent to standard vdom
         # construction.
-        if not data.strip():
+        for part in split_slots(data):
+            match part:
+                case int() | str() if self.root_closed and str(part).strip():
+                    raise RuntimeError(f'unexpected {unescape_placeholder(data.strip())!r} after the root element')
+                case int() as i:
+                    self.lines.append(f'{self.indent()}{self.value(i)},')
+                    self.root_closed = not self.tag_stack
+                case str() if part.strip():
+                    self.lines.append(f'{self.indent()}{part!r},')
+                    self.root_closed = not self.tag_stack
+
+
+def tag_shape(tag: str) -> list[str | None]:
+    # Interpolations in the start and end tags have different positions
+    return [part if isinstance(part, str) else None for part in split_slots(tag)]
+
+
+class StringCodeGenerator(DomCodeGenerator):
+    """Given HTML input with interpolations, generates code that renders it
+    directly to an HTML string, without building a DOM first
+
+    Static HTML, including static attributes, is escaped and merged into
+    constant chunks at codegen time; only the interpolations are rendered
+    when called, with render_child and friends.
+    """
+    globals = {}  # see below, once the helpers are defined
+
+    def __init__(self):
+        super().__init__()
+        self.chunks: list[str] = []
+        self.static: list[str] = []
+
+    @property
+    def code(self) -> str:
+        self.flush()
+        chunks = ''.join(f'    {chunk},\n' for chunk in self.chunks)
+        return f"def compiled(*args):\n  return Markup(''.join((\n{chunks}  )))"
+
+    def add_static(self, html: str) -> None:
+        self.static.append(html)
+
+    def add_code(self, code: str) -> None:
+        self.flush()
+        self.chunks.append(code)
+
+    def flush(self) -> None:
+        if self.static:
+            self.chunks.append(repr(''.join(self.static)))
+            self.static = []
+
+    def add_tag(self, tag: str) -> str | None:
+        # Interpolated tag names are kept in a local for the end tag
+        if any(isinstance(part, int) for part in split_slots(tag)):
+            name = f'tag{len(self.chunks)}'
+            self.add_code(f'({name} := tag_name({self.join(tag)}))')
+            return name
+        self.add_static(unescape_placeholder(tag))
+        return None
+
+    def handle_starttag(self, tag, attrs):
+        self.add_static('<')
+        name = self.add_tag(tag)
+        for k, v in attrs:
+            key = split_slots(k)
+            if all(isinstance(part, str) for part in key) and (v is None or not PLACEHOLDER_RE.search(v)):
+                k = unescape_placeholder(k)
+                self.add_static(f' {k}' if v is None else f' {k}="{escape_html(unescape_placeholder(v))}"')
+            elif v is None and len(key) == 1:
+                self.add_code(f'render_attrs({self.value(key[0])})')
+            else:
+                self.add_code(f'render_attr({self.join(k)}, {"True" if v is None else self.join(v)})')
+        self.add_static('>')
+        if tag not in VOID_ELEMENTS:
+            self.tag_stack.append((tag, name))
+
+    def handle_endtag(self, tag):
+        if tag in VOID_ELEMENTS:
             return
-        self.lines.append(f'{self.indent()}{data!r},')
-
-    def add_interpolation(self, i: int):
-        # There are five possible locations for interpolations, but not all
-        # should be necessarily supported:
-
-        # 1. In the data for some tag: <tag ...>...{interpolation}...</tag>
-        # 2. In the tag, splatted in: <tag {interpolation} ...>
-        # 3. In the tag, as the value: <tag key={interpolation} ...>
-        # 4. In the tag, as the key or as part of it <tag {interpolation}=value ...>
-        # 5. In the tag name itself: <tag{intepolation}... ...>. Such
-        #    functionality also requires it being balanced in the end tag with a
-        #    matching interpolation. At best, this seems tricky.
-        #
-        # Of these, let's at least support #1, #2, #3, given that it's unclear
-        # if #4, #5 are used in practice (or expectation that they would be
-        # supported - this listing is just an opportunity to be exhaustive).
+        if not self.tag_stack or tag_shape(tag) != tag_shape(self.tag_stack[-1][0]):
+            raise RuntimeError(f'unexpected </{tag}>')
+        start, name = self.tag_stack.pop()
+        self.add_static('</')
+        if name is None:
+            self.add_static(unescape_placeholder(start))
+        else:
+            self.add_code(name)
+        self.add_static('>')
 
-        # The convention used here in the codegen is that the code
-        # `args[{i}][0]()` implements the following logic:
-        #
-        #    Call getvalue for the interpolation at the i-th position in args.
-        #
-        # This interpolation could optionally also process formatspec and
-        # conversion, if specified.
-        print(f'raw data seen in the interpolation: {i=} {self.rawdata!r}')
-
-        # At this point when we get this method called, if is processing a start
-        # tag, self.rawdata will have that tag as it is being fed into the
-        # parser - up to the point of the interpolation. Let's use this state
-        # accordingly to implement the "in the tag" support.
-
-        # 1. We are in data, not in a tag. We can just add the code to do the
-        #    interpolation:
-        if not self.rawdata:
-            self.lines.append(f'{self.indent()}args[{i}][0](), ')
-
-        # 2. Splatted mapping, combine with the attributes:
-        elif ENDS_WITH_WHITESPACE_RE.search(self.rawdata):
-            # if we are being careful, we keep track of what we are applying so
-            # first one wins. Let's ignore for now. Also it's probably a good
-            # idea to have a wrapper on any possible TypeError raised if we are
-            # not splatting in a mapping, just to make it easier for usage.
-            # Ignore that too.
-            self.tag_interpolations.append(f'args[{i}][0]()')
-
-        # 3. We have an attribute value interpolation. We need to get what is to
-        #    its left, which is the key. Note that we don't currently support
-        #    quoting the interpolation, since this adds even more fun to the
-        #    logic (we would then have to track that extra state).
-        elif m := ENDS_WITH_ATTRIBUTE_KEY_RE.search(self.rawdata):
-            self.tag_interpolations.append(f'{{{m.group(1)!r}: args[{i}][0]()}}')
-
-
-@cache
-def make_compiled_template(*args: str | CodeType) -> Callable:
-    print(f'Making compiled template {hash(args)}...')
-    builder = DomCodeGenerator()
+    def handle_data(self, data: str):
+        for part in split_slots(data):
+            match part:
+                case int() as i:
+                    self.add_code(f'render_child({self.value(i)})')
+                case str() if self.cdata_elem:
+                    # Script or style, which is not escaped
+                    self.add_static(part)
+                case str():
+                    self.add_static(escape_html(part))
+
+    def handle_decl(self, decl: str):
+        self.add_static(f'<!{decl}>')
+
+
+def render_child(value: Any) -> str:
+    match value:
+        case str() if not hasattr(value, '__html__'):
+            return escape_html(value)
+        case _ if hasattr(value, '__html__'):
+            return value.__html__()
+        case _ if isinstance(value, Iterable):
+            return ''.join(render_child(item) for item in value)
+        case _:
+            return escape_html(str(value))
+
+
+def render_attr(key: Any, value: Any) -> str:
+    key = str(key)
+    if not valid_attribute_name_re.match(key):
+        raise ValueError(f'Not a valid attribute name: {key}')
+    match value:
+        case True:
+            return f' {key}'
+        case False | None:
+            return ''
+        case dict() if key == 'style':
+            # Serialized the same way as by the htm DOM
+            return f' {key}="{escape_html(render_style(value))}"'
+        case dict() if key == 'class':
+            return f' {key}="{escape_html(render_class(value))}"'
+        case _:
+            return f' {key}="{escape_html(str(value))}"'
+
+
+def render_attrs(attrs: Mapping[str, Any]) -> str:
+    return ''.join(render_attr(key, value) for key, value in attrs.items())
+
+
+def tag_name(value: Any) -> str:
+    name = str(value)
+    if not valid_tagname_re.match(name):
+        raise ValueError(f'Not a valid tag: {name}')
+    return name
+
+
+StringCodeGenerator.globals = {
+    'Markup': Markup,
+    'render_child': render_child,
+    'render_attr': render_attr,
+    'render_attrs': render_attrs,
+    'tag_name': tag_name,
+}
+
+
+class CodeCache:
+    """Persists the code generated for templates as marshalled code objects,
+    so that other processes, or this one after a restart, can skip codegen.
+
+    Entries are keyed on a hash of the static strings of the template, the
+    generator version and the Python implementation, which also names the
+    subdirectory, since marshal is not portable across Python versions.
+    Preloaded entries are only kept in memory until first used, after which
+    the compiled template is held by the template cache instead.
+    """
+    def __init__(self, directory: str | os.PathLike):
+        self.directory = Path(directory) / sys.implementation.cache_tag
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.loaded: dict[str, CodeType] = {}
+
+    def key(self, args: Sequence[str | Any]) -> str:
+        h = hashlib.sha256(f'{GENERATOR_VERSION}:{sys.implementation.cache_tag}'.encode())
+        for arg in args:
+            if isinstance(arg, str):
+                encoded = arg.encode('utf-8', 'surrogatepass')
+                h.update(b's%d:' % len(encoded))
+                h.update(encoded)
+            else:
+                h.update(b'i%a:' % (arg,))
+        return h.hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.directory / f'{key}.marshal'
+
+    def get(self, args: Sequence[str | Any]) -> CodeType | None:
+        key = self.key(args)
+        code_obj = self.loaded.pop(key, None)
+        return code_obj if code_obj is not None else self.load(self.path(key))
+
+    def put(self, args: Sequence[str | Any], code_obj: CodeType) -> None:
+        key = self.key(args)
+        # Write then rename, so concurrent readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(code_obj, f)
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def preload(self) -> int:
+        """Loads all entries into memory, returning how many were loaded"""
+        for path in self.directory.glob('*.marshal'):
+            if path.stem not in self.loaded and (code_obj := self.load(path)) is not None:
+                self.loaded[path.stem] = code_obj
+        return len(self.loaded)
+
+    @staticmethod
+    def load(path: Path) -> CodeType | None:
+        try:
+            with open(path, 'rb') as f:
+                code_obj = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        return code_obj if isinstance(code_obj, CodeType) else None
+
+
+_code_cache: CodeCache | None = None
+
+
+def set_code_cache(directory: str | os.PathLike | None, preload: bool = False) -> CodeCache | None:
+    """Enables the on-disk cache of generated code in directory, or disables
+    it with None. Use preload=True at startup to load all cached code."""
+    global _code_cache
+    _code_cache = None if directory is None else CodeCache(directory)
+    if _code_cache is not None and preload:
+        _code_cache.preload()
+    return _code_cache
+
+
+def generate_code(*args: str | tuple, generator: type[DomCodeGenerator] = DomCodeGenerator) -> CodeType:
+    builder = generator()
     for i, arg in enumerate(decode_raw(*args)):
         match arg:
             case str():
                 builder.feed(arg)
-            case _:
-                builder.add_interpolation(i)
-    print("Code:\n", builder.code)
-    code_obj = compile(builder.code, '<string>', 'exec')
-    captured = {}
+            case conv, spec:
+                builder.add_interpolation(i, conv, spec)
+    # HTMLParser holds back trailing text that could be the start of an
+    # entity or tag, such as after a bare &, until it is closed
+    builder.close()
+    return compile(builder.code, '<string>', 'exec')
+
+
+# Compiled templates, keyed on the generator and immutable_bits
+
+_template_cache = LRUCache(maxsize=256)
+
+
+def make_compiled_template(*args: str | tuple, generator: type[DomCodeGenerator] = DomCodeGenerator) -> Callable:
+    return _template_cache.get_or_create(
+        (generator, args), lambda: compile_template(*args, generator=generator))
+
+
+def compile_template(*args: str | tuple, generator: type[DomCodeGenerator] = DomCodeGenerator) -> Callable:
+    code_cache = _code_cache
+    if '<locals>' in generator.__qualname__:
+        # Classes defined in functions can share a name but differ in behaviour
+        code_cache = None
+    key = (f'{generator.__module__}.{generator.__qualname__}', *args)
+    code_obj = code_cache.get(key) if code_cache is not None else None
+    if code_obj is None:
+        code_obj = generate_code(*args, generator=generator)
+        if code_cache is not None:
+            code_cache.put(key, code_obj)
+    captured = dict(generator.globals)
     exec(code_obj, captured)
     return captured['compiled']
 
 
-# The "lambda wrapper" function objects will change at each usage of the call
-# site. Let's use the underlying code object instead as part of the key to
-# construct the compiled function so it can be memoized. This approach is
-# correct, since we will call getvalue in the interpolation in the interpolation.
+def cache_info() -> CacheInfo:
+    return _template_cache.info()
+
+
+def cache_clear() -> None:
+    _template_cache.clear()
+    _call_sites.clear()
+
 
-def immutable_bits(*args: Decoded | Interpolation) -> tuple[str | CodeType]:
+def set_cache_size(maxsize: int | None) -> None:
+    """Bounds the number of compiled templates kept; None means unbounded"""
+    _template_cache.resize(maxsize)
+
+
+# The generated code only depends on the static strings, and where the
+# interpolations are, since it calls getvalue on each interpolation passed
+# in. So the key uses just these, plus the conversion and format spec of each
+# interpolation, and not the code of the interpolation; this way cached
+# templates do not keep the code of dynamically created call sites alive.
+
+def immutable_bits(*args: Decoded | Interpolation) -> tuple[str | tuple]:
     bits = []
     for arg in args:
         if isinstance(arg, str):
             bits.append(arg)
         else:
-            bits.append((arg[0].__code__,))
+            bits.append((arg[2], arg[3]))
     return tuple(bits)
 
 
+# Building the key on every call is linear in the number of interpolations,
+# so compiled templates are also looked up by call site: by the code of the
+# getvalue lambda of the first interpolation, which belongs to the call site.
+# This is weakly keyed, so dynamically created call sites are still freed. As
+# a check, the static strings are compared with the ones seen before, which
+# for the same call site are the same constants, so this is by identity.
+# Templates which do not alternate strings and interpolations, or without
+# interpolations, use the key as above. Only the key is kept for the call
+# site, so that lookups are still counted by, and evicted from, the LRU cache.
+
+_call_sites: WeakKeyDictionary[CodeType, tuple[type, tuple, tuple, tuple]] = WeakKeyDictionary()
+
+_markers = itemgetter(2, 3)
+
+
+def lookup_compiled(args: tuple[Decoded | Interpolation, ...], generator: type[DomCodeGenerator]) -> Callable:
+    site = getattr(args[1][0], '__code__', None) if len(args) > 1 else None
+    key = None
+    if site is not None:
+        entry = _call_sites.get(site)
+        if entry is not None:
+            site_generator, strings, markers, site_key = entry
+            if (site_generator is generator and args[::2] == strings
+                    and tuple(map(_markers, args[1::2])) == markers):
+                key = site_key
+    if key is None:
+        key = generator, immutable_bits(*args)
+        if site is not None and len(args) % 2 and all(isinstance(arg, str) for arg in args[::2]):
+            bits = key[1]
+            _call_sites[site] = generator, bits[::2], bits[1::2], key
+    return _template_cache.get_or_create(key, lambda: compile_template(*key[1], generator=generator))
+
+
 # Makes 'tag' functions to be used like so: html"<body>blah</body>"
 # It needs to be specialized for a specific DOM implementation.
 
 def make_html_tag(f: Callable) -> Callable:
     def html_tag(*args: Decoded | Interpolation) -> Any:
-        compiled = make_compiled_template(*immutable_bits(*args))
+        compiled = lookup_compiled(args, DomCodeGenerator)
         return compiled(f, *args)
     return html_tag
 
 
+# Renders directly to a string, for when a DOM is not needed
+
+def html_str(*args: Decoded | Interpolation) -> Markup:
+    compiled = lookup_compiled(args, StringCodeGenerator)
+    return compiled(*args)
+
+
 def demo():
     # Example usage to adapt. Subset of functionality in IDOM's vdom constructor
     def vdom(tagName: str, attributes: Dict | None, children: List | None) -> Dict:
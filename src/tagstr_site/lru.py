@@ -0,0 +1,134 @@
+"""Bounded LRU cache with statistics, shared by the tag implementations.
+
+`functools.lru_cache` only memoizes a function and does not count
+evictions, while the tag implementations need to cache derived objects
+(parsed templates, generated code) keyed on the static parts of a
+template, and to report on how well that caching is working.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from typing import Any, NamedTuple
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    maxsize: int | None
+    currsize: int
+
+
+_missing = object()
+
+
+class LRUCache:
+    """Maps keys to values, discarding the least recently used entry once
+    `maxsize` entries are stored. A `maxsize` of `None` means unbounded.
+
+    If `ttl` is given, entries also expire that many seconds (as measured by
+    `timer`) after they were stored.
+
+    The cache can be shared between threads. `get_or_create` calls the
+    factory without holding the lock, so concurrent misses for the same key
+    may each create a value, and the last one stored wins.
+    """
+
+    def __init__(
+        self,
+        maxsize: int | None = 128,
+        ttl: float | None = None,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        if maxsize is not None and maxsize < 0:
+            raise ValueError(f'maxsize must be >= 0 or None, got {maxsize!r}')
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.data: OrderedDict[Hashable, Any] = OrderedDict()
+        self.expires: dict[Hashable, float] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self._lookup(key) is not _missing
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            value = self._lookup(key)
+            if value is _missing:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.maxsize == 0:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if self.ttl is not None:
+                self.expires[key] = self.timer() + self.ttl
+            self._evict()
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        with self.lock:
+            value = self._lookup(key)
+            if value is not _missing:
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = factory()
+        self.put(key, value)
+        return value
+
+    def discard(self, key: Hashable) -> bool:
+        """Removes the entry for key, returning whether there was one"""
+        with self.lock:
+            self.expires.pop(key, None)
+            return self.data.pop(key, _missing) is not _missing
+
+    def resize(self, maxsize: int | None) -> None:
+        if maxsize is not None and maxsize < 0:
+            raise ValueError(f'maxsize must be >= 0 or None, got {maxsize!r}')
+        with self.lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.data.clear()
+            self.expires.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self) -> CacheInfo:
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self.data))
+
+    def _lookup(self, key: Hashable) -> Any:
+        value = self.data.get(key, _missing)
+        if value is _missing:
+            return _missing
+        if self.ttl is not None and self.expires[key] <= self.timer():
+            self.discard(key)
+            return _missing
+        self.data.move_to_end(key)
+        return value
+
+    def _evict(self) -> None:
+        if self.maxsize is None:
+            return
+        while len(self.data) > self.maxsize:
+            key, _ = self.data.popitem(last=False)
+            self.expires.pop(key, None)
+            self.evictions += 1
@@ -3,10 +3,14 @@ from __future__ import annotations
 import re
 import sqlite3
 from collections import defaultdict
-from collections.abc import Sequence
-from dataclasses import dataclass, field
-from typing import Any
-
+from collections.abc import Iterable, Iterator, Mapping, Sequence
+from dataclasses import dataclass
+from functools import cached_property
+from itertools import batched, chain
+from math import prod
+from typing import Any, NamedTuple
+
+from tagstr_site.lru import CacheInfo, LRUCache
 from tagstr_site.tagtyping import Decoded, Interpolation
 from tagstr_site.tstring import Template
 
@@ -14,6 +18,15 @@ from tagstr_site.tstring import Template
 # allows for Unicode in the unquoted identifier, per the docs.
 SQLITE3_VALID_UNQUOTED_IDENTIFIER_RE = re.compile(r'[a-z_][a-z0-9_]*')
 
+# Default for SQLITE_MAX_VARIABLE_NUMBER since SQLite 3.32.0; builds can set
+# a different limit, see Connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+SQLITE3_MAX_VARIABLES = 32766
+
+# Format specs that expand a sequence into one placeholder per item:
+# {ids:list} -> :ids_0, :ids_1, ...
+# {rows:values} -> (:rows_0_0, :rows_0_1), (:rows_1_0, :rows_1_1), ...
+EXPANSIONS = ('list', 'values')
+
 
 def _quote_identifier(name: str) -> str:
     if not name:
@@ -35,17 +48,58 @@ class Identifier(str):
 class Param:
     raw: str
     value: Any
+    spec: str | None = None
+
+    def shape(self) -> tuple[int, ...]:
+        """Number of placeholders that the param expands to, per dimension"""
+        match self.spec:
+            case None:
+                return ()
+            case 'list':
+                return (len(self.value),)
+            case 'values':
+                if not self.value:
+                    raise ValueError(f'No rows to expand for {self.raw!r}')
+                width = len(self.value[0])
+                if any(len(row) != width for row in self.value):
+                    raise ValueError(f'Rows for {self.raw!r} must have the same length')
+                return (len(self.value), width)
+
+    def expanded_values(self) -> Iterable[Any]:
+        match self.spec:
+            case None:
+                return (self.value,)
+            case 'list':
+                return self.value
+            case 'values':
+                return chain.from_iterable(self.value)
 
 
 @dataclass
 class SQL(Sequence):
-    """Builds a SQL statements and any bindings from a list of its parts"""
+    """Builds a SQL statements and any bindings from a list of its parts
+
+    Fragments only keep their parts. The statement is analyzed when its sql
+    or bindings are first used, usually only for the outermost statement,
+    so that nested fragments are walked once.
+    """
     parts: list[str | Param | SQL]
-    sql: str = field(init=False)
-    bindings: dict[str, Any] = field(init=False)
 
-    def __post_init__(self):
-        self.sql, self.bindings = analyze_sql(self.parts)
+    @cached_property
+    def key(self) -> tuple:
+        return statement_key(self.parts)
+
+    @cached_property
+    def statement(self) -> Statement:
+        return _statement_cache.get_or_create(self.key, lambda: prepare_statement(self.parts))
+
+    @property
+    def sql(self) -> str:
+        return self.statement.sql
+
+    @cached_property
+    def bindings(self) -> dict[str, Any]:
+        return dict(zip(self.statement.names, param_values(self.parts)))
 
     def __getitem__(self, index):
         match index:
@@ -56,6 +110,31 @@ class SQL(Sequence):
     def __len__(self):
         return 2
 
+    def statements(self, limit: int = SQLITE3_MAX_VARIABLES) -> Iterator[SQL]:
+        """Splits the statement so that each has at most limit bindings
+
+        Only one expanded param, {name:list} or {name:values}, can be split,
+        into consecutive chunks of its items or rows. Everything else is
+        repeated in each statement.
+        """
+        if len(self.bindings) <= limit:
+            yield self
+            return
+        expanded = [param for param in iter_params(self.parts) if param.spec is not None]
+        if len(expanded) != 1:
+            raise ValueError(
+                f'Statement has {len(self.bindings)} bindings, over the limit of {limit}, '
+                f'and can only be split on a single expanded param')
+        param, = expanded
+        shape = param.shape()
+        fixed = len(self.bindings) - prod(shape)
+        per_item = 1 if len(shape) == 1 else shape[1]
+        size = (limit - fixed) // per_item
+        if size < 1:
+            raise ValueError(f'Statement needs more than {limit} bindings for a single item of {param.raw!r}')
+        for chunk in batched(param.value, size):
+            yield SQL(replace_param(self.parts, param, Param(param.raw, list(chunk), param.spec)))
+
     def to_sqlalchemy(self):
         # See https://docs.sqlalchemy.org/en/14/core/sqlelement.html
         # this allows interoperation with SQLAlchemy
@@ -77,20 +156,123 @@ def analyze_sql(parts, bindings=None, param_counts=None) -> tuple[str, dict[str,
                 text.append(part)
             case Identifier(value):
                 text.append(value)
-            case Param(raw, value):
+            case Param(raw, value, spec) as param:
                 if not SQLITE3_VALID_UNQUOTED_IDENTIFIER_RE.fullmatch(raw):
                     # NOTE could slugify this expr, eg 'num + b' -> 'num_plus_b'
                     raw = 'expr'
-                param_counts[(raw, value)] += 1
-                count = param_counts[(raw, value)]
-                name = raw if count == 1 else f'{raw}_{count}'
-                bindings[name] = value
-                text.append(f':{name}')
+                shape = param.shape()
+                # Count by name only, since the same name can be used for
+                # different values, such as in different fragments
+                param_counts[raw] += 1
+                name = raw if param_counts[raw] == 1 else f'{raw}_{param_counts[raw]}'
+                while name in bindings or any(n in bindings for n in expanded_names(name, shape)):
+                    param_counts[raw] += 1
+                    name = f'{raw}_{param_counts[raw]}'
+                match spec:
+                    case None:
+                        bindings[name] = value
+                        text.append(f':{name}')
+                    case 'list':
+                        names = expanded_names(name, shape)
+                        bindings.update(zip(names, value))
+                        text.append(', '.join(f':{n}' for n in names))
+                    case 'values':
+                        names = expanded_names(name, shape)
+                        bindings.update(zip(names, chain.from_iterable(value)))
+                        width = shape[1]
+                        text.append(', '.join(
+                            '(' + ', '.join(f':{n}' for n in names[i:i + width]) + ')'
+                            for i in range(0, len(names), width)))
             case SQL(subparts):
                 text.append(analyze_sql(subparts, bindings, param_counts)[0])
     return ''.join(text), bindings
 
 
+def expanded_names(name: str, shape: tuple[int, ...]) -> list[str]:
+    match shape:
+        case ():
+            return []
+        case (count,):
+            return [f'{name}_{i}' for i in range(count)]
+        case (rows, width):
+            return [f'{name}_{i}_{j}' for i in range(rows) for j in range(width)]
+
+
+def iter_params(parts) -> Iterator[Param]:
+    for part in parts:
+        match part:
+            case Param():
+                yield part
+            case SQL(subparts):
+                yield from iter_params(subparts)
+
+
+def replace_param(parts, old: Param, new: Param) -> list:
+    replaced = []
+    for part in parts:
+        match part:
+            case Param() if part is old:
+                replaced.append(new)
+            case SQL(subparts):
+                replaced.append(SQL(replace_param(subparts, old, new)))
+            case _:
+                replaced.append(part)
+    return replaced
+
+
+# The text of a statement, and the names of its params, only depend on its
+# static parts: the strings, identifiers, the names of the params, and the
+# number of items in expanded params. These
+# are cached, so that only the bindings are built for each call. This also
+# keeps the text identical, so it hits the statement cache of the driver.
+
+class Statement(NamedTuple):
+    sql: str
+    names: tuple[str, ...]
+
+
+_statement_cache = LRUCache(maxsize=256)
+
+
+def statement_key(parts) -> tuple:
+    # Identifiers are already quoted strings
+    key = []
+    for part in parts:
+        match part:
+            case str():
+                key.append(part)
+            case Param(raw, _, spec) as param:
+                key.append(('param', raw, spec, param.shape()) if spec else ('param', raw))
+            case SQL() as fragment:
+                key.append(('sql', fragment.key))
+    return tuple(key)
+
+
+def param_values(parts) -> list[Any]:
+    """Values of the params, in the same order as their names in the Statement"""
+    values = []
+    for part in parts:
+        match part:
+            case Param() as param:
+                values.extend(param.expanded_values())
+            case SQL(subparts):
+                values.extend(param_values(subparts))
+    return values
+
+
+def prepare_statement(parts) -> Statement:
+    text, bindings = analyze_sql(parts)
+    return Statement(text, tuple(bindings))
+
+
+def cache_info() -> CacheInfo:
+    return _statement_cache.info()
+
+
+def cache_clear() -> None:
+    _statement_cache.clear()
+
+
 def sql(template: Template) -> SQL:
     """Implements sql tag"""
     parts = []
@@ -98,15 +280,53 @@ def sql(template: Template) -> SQL:
         match arg:
             case str():
                 parts.append(arg)
-            case getvalue, raw, _, _:
+            case getvalue, raw, _, spec:
                 match value := getvalue():
                     case SQL() | Identifier():
                         parts.append(value)
-                    case _:
+                    case _ if not spec:
                         parts.append(Param(raw, value))
+                    case _ if spec in EXPANSIONS:
+                        parts.append(Param(raw, value, spec))
+                    case _:
+                        raise ValueError(f'Unknown format spec {spec!r} for {raw!r}, expected one of {EXPANSIONS}')
     return SQL(parts)
 
 
+def executemany(
+    cursor: sqlite3.Cursor,
+    statement: SQL | Template,
+    rows: Iterable[Sequence[Any] | Mapping[str, Any]],
+    *,
+    chunk_size: int = 1000,
+    transaction: bool = False,
+) -> int:
+    """Executes the statement for each row, in chunks of rows with executemany
+
+    Only the text of the statement is used. Rows are either tuples of values,
+    in the same order as the params of the statement, or dicts keyed by the
+    param names, as in SQL.bindings. With transaction=True, each chunk is
+    committed, or rolled back on any error. Returns the number of rows
+    modified.
+    """
+    if not isinstance(statement, SQL):
+        statement = sql(statement)
+    names = statement.statement.names
+    count = 0
+    for chunk in batched(rows, chunk_size):
+        params = [
+            row if isinstance(row, Mapping) else dict(zip(names, row, strict=True))
+            for row in chunk
+        ]
+        if transaction:
+            with cursor.connection:
+                cursor.executemany(statement.sql, params)
+        else:
+            cursor.executemany(statement.sql, params)
+        count += cursor.rowcount
+    return count
+
+
 # Based on examples in:
 # https://docs.python.org/3/library/sqlite3.html
 # https://dev.mysql.com/doc/refman/8.0/en/with.html#common-table-expressions-recursive-fibonacci-series
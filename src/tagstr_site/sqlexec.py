@@ -0,0 +1,253 @@
+"""Executes sql tag statements with a pool of sqlite3 connections.
+
+Statements built with the same structure have the same text (see
+`sql.prepare_statement`), so they hit the prepared statement cache that
+sqlite3 keeps for each connection. Connections are reused, at most `size` at
+a time, and each is only used by one thread at a time.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import queue
+import sqlite3
+import threading
+from collections.abc import AsyncIterator, Awaitable, Iterable, Iterator, Mapping, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
+from os import PathLike
+from typing import Any
+
+from tagstr_site import sql as sqltag
+from tagstr_site.sql import SQL
+from tagstr_site.tstring import Template
+
+
+def as_sql(statement: SQL | Template) -> SQL:
+    return statement if isinstance(statement, SQL) else sqltag.sql(statement)
+
+
+class ConnectionPool:
+    """Thread-safe pool of up to `size` connections to a SQLite database
+
+    Connections are opened when first needed. `connection()` waits for up to
+    `timeout` seconds (forever if None) for one to be returned to the pool,
+    then raises TimeoutError: a thread which needs a second connection while
+    holding one, such as by executing statements while iterating over
+    `Executor.fetch_iter`, could otherwise wait forever.
+    """
+
+    def __init__(
+        self,
+        database: str | PathLike,
+        *,
+        size: int = 5,
+        timeout: float | None = 30.0,
+        cached_statements: int = 256,
+        **connect_kwargs: Any,
+    ):
+        if size < 1:
+            raise ValueError(f'size must be >= 1, got {size!r}')
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.connect_kwargs = connect_kwargs | {
+            'cached_statements': cached_statements,
+            # Connections are used by one thread at a time, but not always the same one
+            'check_same_thread': False,
+        }
+        self.idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self.opened: list[sqlite3.Connection] = []
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def __enter__(self) -> ConnectionPool:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def acquire(self) -> sqlite3.Connection:
+        if self.closed:
+            raise RuntimeError('Connection pool is closed')
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if len(self.opened) < self.size:
+                conn = sqlite3.connect(self.database, **self.connect_kwargs)
+                self.opened.append(conn)
+                return conn
+        try:
+            return self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f'No connection available after {self.timeout}s') from None
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        if self.closed:
+            conn.close()
+        else:
+            self.idle.put(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Connection for a single transaction, committed if no exception is raised"""
+        conn = self.acquire()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self.release(conn)
+
+    def close(self) -> None:
+        """Closes idle connections; connections in use are closed when released"""
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class Executor:
+    """Runs SQL statements, or templates for the sql tag, on pooled connections
+
+    Statements with more bindings than `limit` are split with
+    `SQL.statements`, and run in the same transaction.
+    """
+
+    def __init__(self, pool: ConnectionPool, *, limit: int = sqltag.SQLITE3_MAX_VARIABLES):
+        self.pool = pool
+        self.limit = limit
+
+    def execute(self, statement: SQL | Template) -> int:
+        """Returns the number of rows modified"""
+        count = 0
+        with self.pool.connection() as conn:
+            for part in as_sql(statement).statements(self.limit):
+                # rowcount is -1 for statements which do not modify rows,
+                # such as DDL and selects
+                count += max(conn.execute(*part).rowcount, 0)
+        return count
+
+    def executemany(
+        self,
+        statement: SQL | Template,
+        rows: Iterable[Sequence[Any] | Mapping[str, Any]],
+        *,
+        chunk_size: int = 1000,
+    ) -> int:
+        with self.pool.connection() as conn:
+            return sqltag.executemany(conn.cursor(), statement, rows, chunk_size=chunk_size)
+
+    def fetchall(self, statement: SQL | Template) -> list[tuple]:
+        return list(self.fetch_iter(statement))
+
+    def fetch_iter(self, statement: SQL | Template, *, batch_size: int = 500) -> Iterator[tuple]:
+        """Yields the result rows, fetched in batches of batch_size
+
+        The connection is held until the iterator is exhausted or closed.
+        """
+        statement = as_sql(statement)
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.arraysize = batch_size
+            try:
+                for part in statement.statements(self.limit):
+                    cursor.execute(*part)
+                    while batch := cursor.fetchmany():
+                        yield from batch
+            finally:
+                cursor.close()
+
+
+class AsyncExecutor:
+    """Async facade over Executor, running each call in a thread pool
+
+    The thread pool defaults to one worker per pooled connection. Calls wait
+    on the event loop for a connection to be free before being sent to the
+    thread pool, and an iterator from `fetch_iter` holds its connection until
+    it is exhausted or closed, so that workers are never blocked waiting for
+    a connection held between awaits. As for `ConnectionPool.connection`,
+    the wait raises TimeoutError after the pool's timeout.
+
+    Templates are turned into SQL statements when the method is called,
+    rather than when the returned awaitable runs, so that their values are
+    the current ones, as for the sync methods.
+    """
+
+    def __init__(self, executor: Executor, *, max_workers: int | None = None):
+        self.executor = executor
+        self.threads = ThreadPoolExecutor(
+            max_workers=max_workers or executor.pool.size, thread_name_prefix='sqlexec')
+        self.connections = asyncio.Semaphore(executor.pool.size)
+
+    async def __aenter__(self) -> AsyncExecutor:
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def run(self, func, /, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.threads, partial(func, *args, **kwargs))
+
+    @asynccontextmanager
+    async def connection_slot(self) -> AsyncIterator[None]:
+        try:
+            async with asyncio.timeout(self.executor.pool.timeout):
+                await self.connections.acquire()
+        except TimeoutError:
+            raise TimeoutError(f'No connection available after {self.executor.pool.timeout}s') from None
+        try:
+            yield
+        finally:
+            self.connections.release()
+
+    async def run_with_connection(self, func, /, *args, **kwargs):
+        async with self.connection_slot():
+            return await self.run(func, *args, **kwargs)
+
+    def execute(self, statement: SQL | Template) -> Awaitable[int]:
+        return self.run_with_connection(self.executor.execute, as_sql(statement))
+
+    def executemany(
+        self,
+        statement: SQL | Template,
+        rows: Iterable[Sequence[Any] | Mapping[str, Any]],
+        *,
+        chunk_size: int = 1000,
+    ) -> Awaitable[int]:
+        return self.run_with_connection(
+            self.executor.executemany, as_sql(statement), rows, chunk_size=chunk_size)
+
+    def fetchall(self, statement: SQL | Template) -> Awaitable[list[tuple]]:
+        return self.run_with_connection(self.executor.fetchall, as_sql(statement))
+
+    def fetch_iter(self, statement: SQL | Template, *, batch_size: int = 500) -> AsyncIterator[tuple]:
+        """Yields the result rows, fetching each batch in the thread pool"""
+        return self.iter_batches(self.executor.fetch_iter(as_sql(statement), batch_size=batch_size), batch_size)
+
+    async def iter_batches(self, rows: Iterator[tuple], batch_size: int) -> AsyncIterator[tuple]:
+        async with self.connection_slot():
+            try:
+                while batch := await self.run(take, rows, batch_size):
+                    for row in batch:
+                        yield row
+            finally:
+                await self.run(rows.close)
+
+    def close(self) -> None:
+        """Stops the thread pool, without waiting for running calls"""
+        self.threads.shutdown(wait=False)
+
+    async def aclose(self) -> None:
+        """Stops the thread pool, once running calls are done"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.threads.shutdown)
+
+
+def take(rows: Iterator[tuple], n: int) -> list[tuple]:
+    return [row for _, row in zip(range(n), rows)]
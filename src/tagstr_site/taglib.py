@@ -1,3 +1,7 @@
+from __future__ import annotations
+
+import re
+from html import escape
 from typing import Generator
 
 from tagstr_site.tagtyping import Decoded, Interpolation
@@ -34,3 +38,30 @@ def format_value(arg: Decoded | Interpolation) -> str:
                 case _:
                     raise ValueError(f"Bad conversion: {conv!r}")
             return format(value, spec if spec is not None else "")
+
+
+class Markup(str):
+    """A string of HTML that is already escaped, or is otherwise safe to use
+    as is. Tags never escape it again.
+
+    Also supports the __html__ protocol used by other template libraries, such
+    as markupsafe.
+    """
+    __slots__ = ()
+
+    def __html__(self) -> Markup:
+        return self
+
+
+_html_special_re = re.compile(r'[&<>"\']')
+
+
+def escape_html(s: str) -> str:
+    """Escapes s for use in HTML text or a quoted attribute value.
+
+    Markup is returned as is, as is any string without characters that need
+    escaping, which avoids copying the string.
+    """
+    if isinstance(s, Markup) or _html_special_re.search(s) is None:
+        return s
+    return escape(s, quote=True)
@@ -1,6 +1,12 @@
+import asyncio
+import io
+
 import pytest
 
+from tagstr_site import htm
 from tagstr_site.htm import AstParser, InterpolationConcrete, html, HtmlNode
+from tagstr_site.taglib import Markup
+from tagstr_site.tstring import Template
 
 
 def test_ast_basic_parsing():
@@ -21,7 +27,7 @@ def test_ast_basic_placeholder():
     # Manually typing the result since IDE can't process tag functions yet
     root_node = parser.result()
     assert "div" == root_node.tag
-    assert ["Hello ", "x$1x"] == root_node.children
+    assert ["Hello ", 1] == root_node.children
 
 
 def test_basic_tag_usage():
@@ -46,6 +52,80 @@ def test_basic_stringifying():
     assert '<div title="The Greeting">Hello World</div>' == result
 
 
+def test_iter_render():
+    name = "World"
+    root_node = html(t'<div class="greeting"><b>Hello</b> {name}<br/></div>')
+    fragments = list(root_node.iter_render())
+    assert ['<div class="greeting">', '<b>', 'Hello', '</b>', ' ', 'World', '<br/>', '</div>'] == fragments
+    assert str(root_node) == ''.join(fragments)
+
+
+def test_render_to():
+    items = [html(t'<li>{i}</li>') for i in range(3)]
+    buffer = io.StringIO()
+    html(t'<ul>{items}</ul>').render_to(buffer)
+    assert '<ul><li>0</li><li>1</li><li>2</li></ul>' == buffer.getvalue()
+
+
+@pytest.mark.parametrize("compiled", [False, True])
+def test_deep_nesting(compiled):
+    depth = 10_000
+    template = Template((
+        '<div>' * depth,
+        InterpolationConcrete(lambda: 'deep', 'value'),
+        '</div>' * depth,
+    ))
+    root_node = html(template, compiled=compiled)
+    node = root_node
+    for _ in range(depth - 1):
+        node, = node.children
+    assert ['deep'] == node.children
+    assert '<div>' * depth + 'deep' + '</div>' * depth == str(root_node)
+
+
+@pytest.mark.parametrize("compiled", [False, True])
+def test_empty_attrs_and_children_are_shared(compiled):
+    root_node = html(t'<p><br/><img src="a.png"/></p>', compiled=compiled)
+    br, img = root_node.children
+    assert htm.EMPTY_ATTRS is root_node.attrs is br.attrs
+    assert htm.EMPTY_CHILDREN is br.children is img.children
+    assert not hasattr(br, '__dict__')
+    assert '<p><br/><img src="a.png"/></p>' == str(root_node)
+    assert HtmlNode('br', {}, []) == br
+    assert HtmlNode('br') == br
+
+
+def test_default_attrs_and_children_are_not_shared():
+    node = HtmlNode('div')
+    node.children.append('oops')
+    node.attrs['id'] = 'main'
+    assert '<div id="main">oops</div>' == str(node)
+    assert '<span/>' == str(HtmlNode('span'))
+    assert '<p><br/><hr/></p>' == str(html(t'<p><br/><hr/></p>'))
+    with pytest.raises(AttributeError):
+        html(t'<br/>').children.append('oops')
+    with pytest.raises(TypeError):
+        html(t'<br/>').attrs['id'] = 'x'
+
+
+def test_escaped_once():
+    name = "Tom & Jerry"
+    title = '"Cartoons" <classic>'
+    root_node = html(t'<div title={title}>{name} &amp; friends</div>')
+    assert [name, " & friends"] == root_node.children
+    assert '<div title="&quot;Cartoons&quot; &lt;classic&gt;">Tom &amp; Jerry &amp; friends</div>' == str(root_node)
+
+
+def test_markup_is_not_escaped():
+    class Safe:
+        def __html__(self):
+            return "<i>safe</i>"
+
+    bold = Markup("<b>bold</b>")
+    root_node = html(t'<p>{bold} {Safe()} {"<u>"}</p>')
+    assert "<p><b>bold</b> <i>safe</i> &lt;u&gt;</p>" == str(root_node)
+
+
 def test_closing_tag_double_slash():
     root_node = html(t"<div>123<//>")
     assert "div" == root_node.tag
@@ -82,6 +162,224 @@ def test_genexp_in_interpolation():
     assert expected == str(listing)
 
 
+def test_parse_cached_by_static_strings():
+    htm.cache_clear()
+    for i in range(3):
+        root_node = html(t'<li>Item #{i}</li>')
+        assert f'<li>Item #{i}</li>' == str(root_node)
+    info = htm.cache_info()
+    assert (2, 1, 1) == (info.hits, info.misses, info.currsize)
+
+
+def test_parse_cache_evicts_least_recently_used():
+    htm.cache_clear()
+    htm.set_cache_size(2)
+    try:
+        html(t'<a>1</a>')
+        html(t'<b>2</b>')
+        html(t'<a>1</a>')
+        html(t'<i>3</i>')
+        info = htm.cache_info()
+        assert (1, 3, 1, 2) == (info.hits, info.misses, info.evictions, info.currsize)
+        html(t'<a>1</a>')
+        assert 2 == htm.cache_info().hits
+    finally:
+        htm.set_cache_size(256)
+        htm.cache_clear()
+
+
+def test_compiled_matches_interpreted():
+    title = "The <Greeting>"
+    level = 2
+    extra = {"data-x": "y"}
+    for compiled in (False, True):
+        root_node = html(
+            t'<h{level} title={title} class="a" hidden>Hi <b>{title}</b>{[1, 2]}</h{level}>',
+            compiled=compiled)
+        assert "h2" == root_node.tag
+        assert dict(title="The <Greeting>", hidden=True) | {"class": "a"} == root_node.attrs
+        assert "b" == root_node.children[1].tag
+        assert ["1", "2"] == root_node.children[2:]
+
+
+def test_compiled_invalid_tag():
+    name = "x y"
+    with pytest.raises(ValueError) as exc:
+        html(t'<{name}>Hello</{name}>', compiled=True)
+    assert "Not a valid tag: x y" == str(exc.value)
+
+
+def test_node_component():
+    MyComponent = HtmlNode('div', {'class': 'custom'}, ["My component"])
+    result = html(t'<{MyComponent} baz="bar"><p>Extra</p></{MyComponent}>')
+    assert '<div class="custom" baz="bar">My component<p>Extra</p></div>' == str(result)
+
+
+def test_function_component():
+    def Heading(*children, title):
+        return html(t'<header><h1>{title}</h1>{children}</header>')
+
+    result = html(t'<body><{Heading} title="Welcome"><p>Hi</p><//></body>')
+    assert '<body><header><h1>Welcome</h1><p>Hi</p></header></body>' == str(result)
+
+
+def test_cached_component():
+    calls = []
+
+    @htm.cached_component(maxsize=2)
+    def Nav(*children, active):
+        calls.append(active)
+        return html(t'<nav class={active}>{children}</nav>')
+
+    for _ in range(3):
+        result = html(t'<div><{Nav} active="home">Home<//></div>')
+        assert '<div><nav class="home">Home</nav></div>' == str(result)
+    assert ["home"] == calls
+    assert (2, 1) == Nav.cache_info()[:2]
+
+    assert Nav.cache_invalidate("Home", active="home")
+    html(t'<div><{Nav} active="home">Home<//></div>')
+    assert ["home", "home"] == calls
+
+    # HtmlNode children are not hashable, so are not cached
+    html(t'<div><{Nav} active="home"><b>Home</b><//></div>')
+    html(t'<div><{Nav} active="home"><b>Home</b><//></div>')
+    assert 4 == len(calls)
+
+    htm.clear_component_caches()
+    assert 0 == Nav.cache_info().currsize
+
+
+def test_cached_component_key_types():
+    calls = []
+
+    @htm.cached_component
+    def Label(*children, level=1):
+        calls.append((children, level))
+        return html(t'<span data-level={level}>{children}</span>')
+
+    assert '<span data-level="1"><i>x</i></span>' == str(Label(Markup('<i>x</i>')))
+    assert '<span data-level="1">&lt;i&gt;x&lt;/i&gt;</span>' == str(Label('<i>x</i>'))
+    assert '<span data-level="1">x</span>' == str(Label('x', level=1))
+    assert str(Label('x', level=True)) == str(html(t'<span data-level={True}>x</span>'))
+    assert 4 == len(calls)
+
+
+def test_cached_component_ttl_and_serialize():
+    now = [0.0]
+    calls = []
+
+    @htm.cached_component(ttl=10, serialize=True)
+    def Footer():
+        calls.append(now[0])
+        return html(t'<footer>&copy; {len(calls)}</footer>')
+
+    Footer.cache.timer = lambda: now[0]
+    assert Markup('<footer>\xa9 1</footer>') == Footer()
+    now[0] = 5.0
+    assert '<footer>\xa9 1</footer>' == str(html(t'<{Footer}/>'))
+    now[0] = 10.0
+    assert '<footer>\xa9 2</footer>' == Footer()
+    assert [0.0, 10.0] == calls
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_lazy_children(compiled):
+    pulled = []
+
+    def rows(n):
+        for i in range(n):
+            pulled.append(i)
+            yield html(t'<tr><td>{i}</td></tr>')
+
+    node = html(t'<table>{rows(3)}</table>', compiled=compiled, lazy=True)
+    assert [] == pulled
+    fragments = node.iter_render()
+    assert '<table>' == next(fragments)
+    assert '<tr>' == next(fragments)
+    assert [0] == pulled
+    assert '<td>0</td></tr><tr><td>1</td></tr><tr><td>2</td></tr></table>' == ''.join(fragments)
+    assert [0, 1, 2] == pulled
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_lazy_children_empty(compiled):
+    def items(n):
+        yield from range(n)
+
+    for template in (
+        lambda: t'<ul>{items(0)}</ul>',
+        lambda: t'<ul>{items(0)}{[]}{items(0)}</ul>',
+        lambda: t'<ul>{items(0)}{items(2)}</ul>',
+        lambda: t'<div><ul>{items(0)}</ul><p>{items(1)}</p></div>',
+    ):
+        eager = str(html(template(), compiled=compiled))
+        assert eager == str(html(template(), compiled=compiled, lazy=True))
+    assert '<ul/>' == str(html(t'<ul>{items(0)}</ul>', compiled=compiled, lazy=True))
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_hoist_static_subtrees(compiled):
+    def page(title):
+        return t'<body><header><nav class="main"><a href="/">Home</a></nav></header><h1>{title}</h1><p>Static <b>text</b></p></body>'
+
+    node = html(page("Hi"), compiled=compiled, hoist=True)
+    header, h1, p = node.children
+    assert Markup('<header><nav class="main"><a href="/">Home</a></nav></header>') == header
+    assert isinstance(h1, HtmlNode)
+    assert Markup('<p>Static <b>text</b></p>') == p
+    for title in ("Hi", "<Bye>"):
+        assert str(html(page(title), compiled=compiled)) == str(html(page(title), compiled=compiled, hoist=True))
+
+
+def test_hoist_keeps_component_children():
+    def Wrapper(*children):
+        return html(t'<div>{len(children)} {children}</div>')
+
+    assert '<div>1 <b>x</b></div>' == str(html(t'<{Wrapper}><b>x</b></{Wrapper}>', hoist=True))
+
+
+def test_ahtml_resolves_concurrently():
+    first, second = asyncio.Event(), asyncio.Event()
+
+    async def get_first():
+        # Deadlocks unless get_second runs at the same time
+        first.set()
+        await second.wait()
+        return "first"
+
+    async def get_second():
+        await first.wait()
+        second.set()
+        return "second"
+
+    async def items():
+        for i in range(3):
+            yield i
+
+    async def main():
+        return await htm.ahtml(t'<p title={get_first()}>{get_second()} {items()}</p>')
+
+    assert '<p title="first">second 012</p>' == str(asyncio.run(main()))
+
+
+def test_aiter_render_streams():
+    async def main():
+        done = asyncio.Event()
+
+        async def slow():
+            await done.wait()
+            return html(t'<b>{"<slow>"}</b>')
+
+        chunks = []
+        async for chunk in htm.aiter_render(t'<div><h1>Title</h1>{slow()}<p>end</p></div>'):
+            chunks.append(chunk)
+            done.set()
+        return chunks
+
+    assert ['<div><h1>Title</h1>', '<b>&lt;slow&gt;</b><p>end</p></div>'] == asyncio.run(main())
+
+
 @pytest.mark.skip(reason="Not implemented yet")
 def test_basic_component():
     MyComponent = HtmlNode('div', {'class': 'custom'}, ["My component"])
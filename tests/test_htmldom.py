@@ -0,0 +1,99 @@
+import pytest
+
+from tagstr_site import htmldom
+from tagstr_site.htmldom import HtmlNode, html
+
+
+def test_basic():
+    name = "World"
+    assert HtmlNode("div", {}, ["Hello ", "World"]) == html(*t'<div>Hello {name}</div>'.args)
+
+
+def test_attributes():
+    attrs = {"id": "main"}
+    name, level = "x", 2
+    node = html(*t'<div {attrs} title={name} data-x="a{name}b{level}" hidden>$x$0x</div>'.args)
+    assert '<div id="main" title="x" data-x="axb2" hidden>$x$0x</div>' == str(node)
+
+
+def test_prepared_once_bound_many():
+    htmldom.cache_clear()
+    for i in range(3):
+        assert f'<li class="c{i}">{i}</li>' == str(html(*t'<li class="c{i}">{i}</li>'.args))
+    assert (2, 1) == htmldom.cache_info()[:2]
+
+    prepared = htmldom.prepare(*t'<b a={1} b={2}>{3}</b>'.args)
+    assert 3 == prepared.slots
+    assert '<b a="x" b="y">z</b>' == str(prepared.bind(["x", "y", "z"]))
+    with pytest.raises(ValueError):
+        prepared.bind(["x"])
+
+
+def test_end_tag():
+    level = 2
+    assert '<h2>T</h2>' == str(html(*t'<h{level}>T</h{level}>'.args))
+    assert '<h2>T</h2>' == str(html(*t'<h{level}>T</{...}>'.args))
+    with pytest.raises(SyntaxError):
+        html(*t'<h{level}>T</h3>'.args)
+    with pytest.raises(SyntaxError):
+        html(*t'<p>T</div>'.args)
+
+
+def test_conversion():
+    name = "World"
+    assert "<p>'World'</p>" == str(html(*t'<p>{name!r}</p>'.args))
+
+
+def test_components_resolved_once():
+    calls = []
+
+    def Item(label):
+        calls.append(label)
+        return html(*t'<li>{label}</li>'.args)
+
+    def List(*children):
+        calls.append("list")
+        return html(*t'<ul>{children}</ul>'.args)
+
+    node = html(*t'<div><{List}><{Item} label="a"/><{Item} label="b"/></{List}></div>'.args)
+    assert '<div><ul><li>a</li><li>b</li></ul></div>' == str(node)
+    assert ["list", "a", "b"] == calls
+
+
+def test_memo_component():
+    calls = []
+
+    @htmldom.memo_component
+    def Item(label):
+        calls.append(label)
+        return html(*t'<li>{label}</li>'.args)
+
+    for _ in range(3):
+        assert '<ul><li>a</li></ul>' == str(html(*t'<ul><{Item} label="a"/></ul>'.args))
+    assert ["a"] == calls
+    assert (2, 1) == Item.cache_info()[:2]
+
+
+def test_whitespace_normalized():
+    name = "World"
+    node = html(*t"""
+        <div>
+            <p>Hello {name}</p>
+              
+            <p>x</p>
+        </div>
+    """.args)
+    assert '\n<div>\n    <p>Hello World</p>\n\n    <p>x</p>\n</div>\n' == str(node)
+    assert '<div>\n    <p>a</p>\n  </div>' == str(html(*t"""<div>
+    <p>a</p>
+  </div>""".args))
+
+
+def test_memo_component_key_types():
+    @htmldom.memo_component
+    def Item(flag):
+        return html(*t'<li title={flag}>x</li>'.args)
+
+    assert '<ul><li title>x</li></ul>' == str(html(*t'<ul><{Item} flag={True} /></ul>'.args))
+    assert '<ul><li title="1">x</li></ul>' == str(html(*t'<ul><{Item} flag={1} /></ul>'.args))
+    assert (0, 2) == Item.cache_info()[:2]
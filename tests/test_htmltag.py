@@ -0,0 +1,174 @@
+import gc
+import weakref
+
+import pytest
+
+from tagstr_site import htm, htmltag
+from tagstr_site.builtins import InterpolationConcrete
+from tagstr_site.taglib import Markup
+
+
+def vdom(tag, attrs, children):
+    return {'tagName': tag, 'attributes': attrs, 'children': children}
+
+
+html = htmltag.make_html_tag(vdom)
+
+
+@pytest.fixture
+def code_cache(tmp_path):
+    htmltag.cache_clear()
+    yield htmltag.set_code_cache(tmp_path)
+    htmltag.set_code_cache(None)
+    htmltag.cache_clear()
+
+
+def test_basic():
+    name = 'World'
+    assert vdom('div', {}, ['Hello ', 'World']) == html(*t'<div>Hello {name}</div>'.args)
+
+
+def test_code_cache(tmp_path, code_cache, monkeypatch):
+    name = 'World'
+    expected = vdom('p', {'title': 'World'}, ['World'])
+    assert expected == html(*t'<p title={name}>{name}</p>'.args)
+    assert 1 == len(list(code_cache.directory.glob('*.marshal')))
+
+    # Another process, which preloads the cache when starting
+    htmltag.cache_clear()
+    assert 1 == htmltag.set_code_cache(tmp_path, preload=True).preload()
+
+    def fail(*args, **kwargs):
+        raise AssertionError('Should use the cached code')
+
+    monkeypatch.setattr(htmltag, 'generate_code', fail)
+    assert expected == html(*t'<p title={name}>{name}</p>'.args)
+    # Handed over to the template cache
+    assert {} == htmltag._code_cache.loaded
+
+
+def test_code_cache_key(code_cache):
+    key = code_cache.key(('<p>', (None, None), '</p>'))
+    assert key == code_cache.key(('<p>', (None, None), '</p>'))
+    assert key != code_cache.key(('<p>', ('r', None), '</p>'))
+    assert key != code_cache.key(('<p>', (None, None), '</b>'))
+    assert code_cache.key(('a', 'b')) != code_cache.key(('ab',))
+
+
+def test_template_cache(capsys):
+    htmltag.cache_clear()
+    for _ in range(3):
+        htmltag.make_compiled_template('<b>', (None, None), '</b>')
+    assert (2, 1, 0) == htmltag.cache_info()[:3]
+
+    htmltag.set_cache_size(1)
+    try:
+        htmltag.make_compiled_template('<i>', (None, None), '</i>')
+        assert 1 == htmltag.cache_info().evictions
+        assert 1 == htmltag.cache_info().currsize
+    finally:
+        htmltag.set_cache_size(256)
+    assert '' == capsys.readouterr().out
+
+
+def test_template_cache_generators(code_cache):
+
+    def make_generator(value):
+        class Generator(htmltag.DomCodeGenerator):
+            def handle_data(self, data):
+                super().handle_data(value)
+        return Generator
+
+    first, second = make_generator('first'), make_generator('second')
+    assert first.__name__ == second.__name__
+    assert vdom('b', {}, ['first']) == htmltag.make_compiled_template('<b>x</b>', generator=first)(vdom)
+    assert vdom('b', {}, ['second']) == htmltag.make_compiled_template('<b>x</b>', generator=second)(vdom)
+    assert [] == list(code_cache.directory.glob('*.marshal'))
+
+
+def test_interpolation_positions():
+    b, level, k, name = 'bee', 2, 'key', 'World'
+    attrs = {'x': 1}
+    node = html(*t'<div class="a {b}" title="{name}" {attrs} data-{k}={level} id=x><h{level}>{name!r:>8}</h{level}><br></div>'.args)
+    assert vdom('div', {'class': 'a bee', 'title': 'World', 'x': 1, 'data-key': 2, 'id': 'x'}, [
+        vdom('h2', {}, [" 'World'"]),
+        vdom('br', {}, []),
+    ]) == node
+
+
+def test_end_tag_must_match():
+    level = 2
+    with pytest.raises(RuntimeError):
+        html(*t'<h{level}>x</h3>'.args)
+
+
+def test_html_str():
+    b, level, name = 'b<e>', 2, 'World'
+    attrs = {'x': 1, 'on': True, 'off': False}
+    items = [name, Markup('<i>x</i>')]
+    result = htmltag.html_str(*t'<div class="a {b}" {attrs} id=x><h{level}>{name!r} &amp;</h{level}><br>{items}</div>'.args)
+    assert isinstance(result, Markup)
+    assert '<div class="a b&lt;e&gt;" x="1" on id="x"><h2>&#x27;World&#x27; &amp;</h2><br>World<i>x</i></div>' == result
+
+    with pytest.raises(ValueError):
+        level = '2 onclick=x'
+        htmltag.html_str(*t'<h{level}>x</h{level}>'.args)
+
+
+def test_html_str_style_and_class_dicts():
+    attrs = {'style': {'color': 'red', 'font-family': '"a" b'}, 'class': {'big': True, 'hidden': False, 'x': 1}}
+    result = htmltag.html_str(*t'<p {attrs}>x</p>'.args)
+    assert '<p style="color: red; font-family: &quot;a&quot; b" class="big x">x</p>' == result
+    # Renders as the htm DOM does
+    assert str(htm.html(t'<p {attrs}>x</p>')) == result
+    style, names = attrs['style'], attrs['class']
+    assert str(htm.html(t'<p style={style} class={names}>x</p>')) == result
+
+
+def test_trailing_text_with_ampersand():
+    a, b = 'Tom', 'Jerry'
+    assert 'Tom&amp;Jerry' == htmltag.html_str(*t'{a}&{b}'.args)
+    assert '<p>Tom</p> R&amp;D' == htmltag.html_str(*t'<p>{a}</p> R&D'.args)
+    assert '<p>Tom &amp; Jerry</p> &amp;' == htmltag.html_str(*t'<p>{a} &amp; {b}</p> &'.args)
+    assert vdom('p', {}, ['Tom', ' R&D']) == html(*t'<p>{a} R&D</p>'.args)
+    # The DOM has a single root
+    with pytest.raises(RuntimeError):
+        html(*t'<p>{a}</p> R&D'.args)
+    with pytest.raises(RuntimeError):
+        html(*t'{a}&{b}'.args)
+
+
+def test_call_site_cache():
+    htmltag.cache_clear()
+    for i in range(3):
+        assert vdom('b', {}, [i]) == html(*t'<b>{i}</b>'.args)
+    # Only the first call builds the key, but all are counted
+    assert (2, 1) == htmltag.cache_info()[:2]
+
+    # Another template with the same getvalue code is still checked
+    def value(v):
+        return lambda: v
+
+    for tag in ('b', 'i'):
+        args = (f'<{tag}>', InterpolationConcrete(value(tag), 'tag'), f'</{tag}>')
+        assert vdom(tag, {}, [tag]) == html(*args)
+    assert (3, 2) == htmltag.cache_info()[:2]
+
+
+def test_call_site_cache_eviction():
+    htmltag.cache_clear()
+    htmltag.set_cache_size(1)
+    try:
+        def render(i):
+            return html(*t'<b>{i}</b>'.args)
+
+        assert vdom('b', {}, [0]) == render(0)
+        compiled = weakref.ref(htmltag.make_compiled_template('<b>', (None, None), '</b>'))
+        htmltag.make_compiled_template('<i>', (None, None), '</i>')
+        gc.collect()
+        assert compiled() is None
+        # The call site still works, compiling the template again
+        assert vdom('b', {}, [1]) == render(1)
+        assert (1, 3, 2) == htmltag.cache_info()[:3]
+    finally:
+        htmltag.set_cache_size(256)
@@ -0,0 +1,52 @@
+import threading
+import time
+
+from tagstr_site.lru import LRUCache
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert 1 == cache.get('a')
+    cache.put('c', 3)
+    assert 'b' not in cache
+    assert (1, 0, 1, 2, 2) == cache.info()
+
+
+def test_ttl():
+    now = 0.0
+    cache = LRUCache(ttl=10, timer=lambda: now)
+    assert 1 == cache.get_or_create('a', lambda: 1)
+    now = 10.0
+    assert 2 == cache.get_or_create('a', lambda: 2)
+    assert (0, 2) == cache.info()[:2]
+
+
+def test_threads():
+    def timer():
+        # Lets other threads run in the middle of a lookup
+        time.sleep(0)
+        return 0.0
+
+    cache = LRUCache(maxsize=1, ttl=60, timer=timer)
+    errors = []
+
+    def run(i):
+        try:
+            for j in range(500):
+                key = (i + j) % 3
+                assert key == cache.get_or_create(key, lambda: key)
+                cache.get(key)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [] == errors
+    info = cache.info()
+    assert 8 * 500 * 2 == info.hits + info.misses
+    assert 1 == info.currsize
@@ -0,0 +1,133 @@
+import sqlite3
+
+import pytest
+
+from tagstr_site import sql as sqltag
+from tagstr_site.sql import Identifier, sql
+
+
+def test_bindings():
+    name, date = 'C', 1972
+    statement = sql(t'insert into {Identifier("lang")} values ({name}, {date})')
+    assert ('insert into lang values (:name, :date)', {'name': 'C', 'date': 1972}) == tuple(statement)
+
+
+def test_same_name_different_values():
+    num = 1
+    inner = sql(t'select {num}')
+    num = 2
+    statement = sql(t'select ({inner}), {num}, {num}')
+    assert 'select (select :num), :num_2, :num_3' == statement.sql
+    assert {'num': 1, 'num_2': 2, 'num_3': 2} == statement.bindings
+
+
+def test_statement_cache():
+    sqltag.cache_clear()
+    statements = [sql(t'select * from t where a = {i} and b = {i + 1}') for i in range(3)]
+    assert (0, 0) == sqltag.cache_info()[:2]
+    for statement in statements:
+        statement.sql
+    assert (2, 1) == sqltag.cache_info()[:2]
+    assert statements[0].sql is statements[2].sql
+    assert {'i': 2, 'expr': 3} == statements[2].bindings
+
+
+def test_demo():
+    sqltag.demo()
+
+
+def test_executemany():
+    with sqlite3.connect(':memory:') as conn:
+        cur = conn.cursor()
+        cur.execute('create table t (a, b)')
+        a = b = None
+        insert = sql(t'insert into t values ({a}, {b})')
+        assert 2500 == sqltag.executemany(cur, insert, ((i, i * 2) for i in range(2500)), chunk_size=1000)
+        # Only the names of the params are needed, not their values
+        assert 'bindings' not in vars(insert)
+        assert 2 == sqltag.executemany(cur, t'insert into t values ({a}, {b})', [{'a': -1, 'b': 0}, (-2, 0)])
+        assert [(2502, 6247500)] == list(cur.execute('select count(*), sum(b) from t'))
+
+
+def test_executemany_transaction(tmp_path):
+    with sqlite3.connect(tmp_path / 'test.db') as conn:
+        cur = conn.cursor()
+        cur.execute('create table t (a primary key)')
+        conn.commit()
+        a = None
+        rows = [(1,), (2,), (3,), (3,)]
+        try:
+            sqltag.executemany(cur, t'insert into t values ({a})', rows, chunk_size=2, transaction=True)
+        except sqlite3.IntegrityError:
+            pass
+        # The first chunk was committed, the second rolled back
+        assert [(1,), (2,)] == list(cur.execute('select a from t order by a'))
+
+
+def test_expand_list():
+    ids = [3, 1, 4]
+    statement = sql(t'select * from t where a in ({ids:list}) or b = {ids}')
+    assert 'select * from t where a in (:ids_0, :ids_1, :ids_2) or b = :ids_3' == statement.sql
+    assert {'ids_0': 3, 'ids_1': 1, 'ids_2': 4, 'ids_3': ids} == statement.bindings
+
+    sqltag.cache_clear()
+    for ids in ([1, 2], [3, 4], [5]):
+        sql(t'select {ids:list}').sql
+    assert (1, 2) == sqltag.cache_info()[:2]
+
+    with pytest.raises(ValueError):
+        sql(t'select {ids:tuple}')
+
+
+def test_expand_values():
+    with sqlite3.connect(':memory:') as conn:
+        cur = conn.cursor()
+        cur.execute('create table t (a, b)')
+        rows = [(1, 'x'), (2, 'y')]
+        statement = sql(t'insert into t values {rows:values}')
+        assert 'insert into t values (:rows_0_0, :rows_0_1), (:rows_1_0, :rows_1_1)' == statement.sql
+        cur.execute(*statement)
+        assert rows == list(cur.execute('select * from t'))
+
+        with pytest.raises(ValueError):
+            sql(t'insert into t values {[(1, 2), (3,)]:values}').sql
+
+
+def test_statements_split_at_limit():
+    with sqlite3.connect(':memory:') as conn:
+        cur = conn.cursor()
+        cur.execute('create table t (a, b, c)')
+        c = 'c'
+        rows = [(i, i * 2) for i in range(40_000)]
+        statement = sql(t'insert into t select column1, column2, {c} from (values {rows:values})')
+        assert 80_001 == len(statement.bindings)
+        statements = list(statement.statements())
+        assert 3 == len(statements)
+        assert all(len(s.bindings) <= sqltag.SQLITE3_MAX_VARIABLES for s in statements)
+        for s in statements:
+            cur.execute(*s)
+        assert [(40_000, sum(range(40_000)), 1)] == list(cur.execute('select count(*), sum(a), count(distinct c) from t'))
+
+        ids = list(range(10))
+        selects = list(sql(t'select a from t where a in ({ids:list}) and c = {c}').statements(limit=4))
+        assert [3, 3, 3, 1] == [len(s.bindings) - 1 for s in selects]
+        assert ids == [a for s in selects for a, in cur.execute(*s)]
+
+
+def test_nested_fragments_analyzed_once(monkeypatch):
+    calls = []
+    analyze_sql = sqltag.analyze_sql
+
+    def counting(parts, *args):
+        calls.append(parts)
+        return analyze_sql(parts, *args)
+
+    monkeypatch.setattr(sqltag, 'analyze_sql', counting)
+    sqltag.cache_clear()
+    query = sql(t'select a from t where a > {0}')
+    for i in range(10):
+        query = sql(t'select * from ({query}) where a < {100 - i}')
+    assert [] == calls
+    assert 11 == len(query.bindings)
+    assert 11 == len(calls)  # the outermost, then each of the nested fragments once
+    assert query.sql is query.statement.sql
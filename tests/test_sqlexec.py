@@ -0,0 +1,143 @@
+import asyncio
+import threading
+
+import pytest
+
+from tagstr_site.sql import sql
+from tagstr_site.sqlexec import AsyncExecutor, ConnectionPool, Executor
+
+
+@pytest.fixture
+def executor(tmp_path):
+    with ConnectionPool(tmp_path / 'test.db', size=2, timeout=1) as pool:
+        executor = Executor(pool)
+        executor.execute(t'create table t (a, b)')
+        yield executor
+
+
+def test_execute_and_fetch(executor):
+    assert 0 == executor.execute(t'create table u (a)')
+    assert 0 == executor.execute(t'select * from t')
+    rows = [(i, f'b{i}') for i in range(1200)]
+    assert 1200 == executor.execute(t'insert into t values {rows:values}')
+    assert rows == executor.fetchall(t'select a, b from t order by a')
+
+    a = 10
+    it = executor.fetch_iter(sql(t'select a from t where a < {a} order by a'), batch_size=3)
+    assert (0,) == next(it)
+    assert list(range(1, 10)) == [a for a, in it]
+
+
+def test_split_statements(tmp_path):
+    with ConnectionPool(tmp_path / 'test.db') as pool:
+        executor = Executor(pool, limit=10)
+        executor.execute(t'create table t (a)')
+        rows = [(i,) for i in range(25)]
+        assert 25 == executor.execute(t'insert into t values {rows:values}')
+        ids = list(range(0, 25, 2))
+        assert ids == [a for a, in executor.fetch_iter(t'select a from t where a in ({ids:list})')]
+
+
+def test_transaction_rolled_back(executor):
+    with pytest.raises(ZeroDivisionError):
+        with executor.pool.connection() as conn:
+            conn.execute('insert into t values (1, 2)')
+            1 / 0
+    assert [] == executor.fetchall(t'select * from t')
+
+
+def test_pool_reuses_connections(executor):
+    pool = executor.pool
+    with pool.connection() as conn:
+        pass
+    with pool.connection() as again:
+        assert conn is again
+        with pool.connection() as other:
+            assert other is not conn
+            with pytest.raises(TimeoutError):
+                pool.acquire()
+    assert 2 == len(pool.opened)
+
+
+def test_pool_threads(executor):
+    def insert(i):
+        for j in range(20):
+            executor.execute(t'insert into t values ({i}, {j})')
+
+    threads = [threading.Thread(target=insert, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [(160,)] == executor.fetchall(t'select count(*) from t')
+    assert 2 == len(executor.pool.opened)
+
+
+def test_async_executor(executor):
+    async def main():
+        async with AsyncExecutor(executor) as aexecutor:
+            await asyncio.gather(*(
+                aexecutor.execute(t'insert into t values ({i}, {i * i})') for i in range(10)))
+            rows = [(i, -i) for i in range(10, 20)]
+            assert 10 == await aexecutor.executemany(t'insert into t values ({0}, {1})', rows)
+            return [row async for row in aexecutor.fetch_iter(t'select a from t order by a', batch_size=4)]
+
+    assert [(i,) for i in range(20)] == asyncio.run(main())
+
+
+def test_async_executor_close(executor):
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+
+    async def main():
+        aexecutor = AsyncExecutor(executor)
+        running = asyncio.ensure_future(aexecutor.run(slow))
+        await asyncio.to_thread(started.wait, 5)
+        closing = asyncio.ensure_future(aexecutor.aclose())
+        # The event loop is not blocked while the pool shuts down
+        await asyncio.sleep(0.01)
+        assert not closing.done()
+        release.set()
+        await asyncio.gather(running, closing)
+
+    asyncio.run(main())
+
+
+def test_async_iterators_exceed_pool(executor):
+    executor.executemany(t'insert into t values ({0}, {1})', [(i, i) for i in range(10)])
+    executor.execute(t'create table u (a)')
+
+    async def main():
+        async with AsyncExecutor(executor) as aexecutor:
+            async def fetch(i):
+                rows = [a async for a, in aexecutor.fetch_iter(t'select a from t order by a', batch_size=2)]
+                await aexecutor.execute(t'insert into u values ({i})')
+                return rows
+
+            # More open iterators than connections, mixed with other calls
+            return await asyncio.gather(*(fetch(i) for i in range(5)))
+
+    assert [list(range(10))] * 5 == asyncio.run(main())
+    assert [(5,)] == executor.fetchall(t'select count(*) from u')
+
+
+def test_nested_use_times_out(tmp_path):
+    with ConnectionPool(tmp_path / 'test.db', size=1, timeout=0.1) as pool:
+        executor = Executor(pool)
+        executor.execute(t'create table t (a)')
+        executor.execute(t'insert into t values (1), (2)')
+        with pytest.raises(TimeoutError):
+            for row in executor.fetch_iter(t'select a from t'):
+                executor.execute(t'insert into t values (2)')
+
+        async def main():
+            async with AsyncExecutor(executor) as aexecutor:
+                async for row in aexecutor.fetch_iter(t'select a from t', batch_size=1):
+                    await aexecutor.execute(t'insert into t values (2)')
+
+        with pytest.raises(TimeoutError):
+            asyncio.run(main())